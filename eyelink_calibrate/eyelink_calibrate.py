@@ -19,8 +19,35 @@ from libopensesame import item, exceptions, debug
 from libqtopensesame import qtplugin
 import os.path
 import imp
+import sys
 from PyQt4 import QtGui, QtCore
 
+def load_libeyelink():
+
+	"""
+	Loads libeyelink, which lives in the plug-in folder. The module is loaded
+	only once per process (through the bytecode cache if possible) and then
+	taken from sys.modules, so that preparing the item again is cheap and
+	the libeyelink classes, as well as the tracker connection, stay the same.
+	The module is registered as eyelink_calibrate_libeyelink, so that it
+	is not confused with another module called libeyelink, for example
+	from an older copy of the plug-in.
+
+	Returns:
+	The libeyelink module
+	"""
+	
+	name = "eyelink_calibrate_libeyelink"
+	if name in sys.modules:
+		return sys.modules[name]
+	f, path, description = imp.find_module("libeyelink", \
+		[os.path.dirname(__file__)])
+	try:
+		return imp.load_module(name, f, path, description)
+	finally:
+		if f != None:
+			f.close()
+
 class eyelink_calibrate(item.item):
 
 	"""
@@ -47,6 +74,14 @@ class eyelink_calibrate(item.item):
 		self.sacc_acc_thresh = 9500
 		self.cal_target_size = 16
 		self.cal_beep = 'yes'
+		self._mode_per_trial = "Per trial"
+		self._mode_continuous = "Continuous"
+		self.recording_mode = self._mode_per_trial
+		self.realtime_policy = "pylink"
+		self.health_monitor = "no"
+		self.async_logging = "no"
+		self.mirror_log = "no"
+		self.background_connect = "no"
 
 		# This options makes OpenSesame restart automatically after each session,
 		# but this is not neessary anymore
@@ -70,8 +105,7 @@ class eyelink_calibrate(item.item):
 
 		# Create an eyelink instance if it doesn't exist yet. Libeyelink is
 		# dynamically loaded
-		path = os.path.join(os.path.dirname(__file__), "libeyelink.py")
-		libeyelink = imp.load_source("libeyelink", path)
+		libeyelink = load_libeyelink()
 
 		if self.get("tracker_attached") == self._text_attached:
 
@@ -91,7 +125,17 @@ class eyelink_calibrate(item.item):
 
 			print "eyelink_calibrate(): logging tracker data as %s" % data_file
 			debug.msg("loading libeyelink")
-			self.experiment.eyelink = libeyelink.libeyelink(self.experiment, (self.get("width"), self.get("height")), data_file = data_file, saccade_velocity_threshold = self.get("sacc_vel_thresh"), saccade_acceleration_threshold = self.get("sacc_acc_thresh"))
+			self.experiment.eyelink = libeyelink.libeyelink(self.experiment, (self.get("width"), self.get("height")), data_file = data_file, saccade_velocity_threshold = self.get("sacc_vel_thresh"), saccade_acceleration_threshold = self.get("sacc_acc_thresh"), background = self.get("background_connect") == "yes")
+			self.experiment.eyelink.set_continuous_recording( \
+				self.get("recording_mode") == self._mode_continuous)
+			self.experiment.eyelink.set_realtime_policy(self.get("realtime_policy"))
+			if self.get("health_monitor") == "yes":
+				self.experiment.eyelink.set_health_monitor()
+			if self.get("async_logging") == "yes":
+				self.experiment.eyelink.set_async_logging()
+			if self.get("mirror_log") == "yes":
+				self.experiment.eyelink.set_mirror_log()
+			self.experiment.eyelink.expect_setup()
 			self.experiment.cleanup_functions.append(self.close)
 			if self.get("restart") == "Yes":
 				self.experiment.restart = True
@@ -172,6 +216,18 @@ class qteyelink_calibrate(eyelink_calibrate, qtplugin.qtplugin):
 				tooltip = "Indicates whether a beep sounds when the calibration target jumps")
 		self.add_spinbox_control("cal_target_size", "Calibration target size", 0, 256,
 			tooltip = "The size of the calibration target in pixels")			
+		self.add_combobox_control("recording_mode", "Recording mode", [self._mode_per_trial, self._mode_continuous], \
+			tooltip = "Continuous mode keeps recording across trials and only marks the trial boundaries")
+		self.add_combobox_control("realtime_policy", "Real-time priority", ["pylink", "native", "off"], \
+			tooltip = "How the priority of the experiment is raised during recording")
+		self.add_combobox_control("health_monitor", "Monitor dropped samples", ["no", "yes"], \
+			tooltip = "Check for gaps in the link data and flag trials with too many dropped samples")
+		self.add_combobox_control("async_logging", "Asynchronous logging", ["no", "yes"], \
+			tooltip = "Send log messages from a background thread, with the timestamp of the moment that they were logged")
+		self.add_combobox_control("mirror_log", "Local copy of messages", ["no", "yes"], \
+			tooltip = "Also write all messages and commands to a local file, which can be followed during the experiment")
+		self.add_combobox_control("background_connect", "Connect in background", ["no", "yes"], \
+			tooltip = "Connect to the tracker while the rest of the experiment is prepared")
 		self.add_line_edit_control("sacc_vel_thresh", "Saccade velocity threshold", default = self.get("sacc_vel_thresh"), \
 			tooltip = "Saccade detection parameter")
 		self.add_line_edit_control("sacc_acc_thresh", "Saccade acceleration threshold", default = self.get("sacc_acc_thresh"), \
@@ -15,46 +15,136 @@ You should have received a copy of the GNU General Public License
 along with OpenSesame.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import time
+_t_load = time.time()
+
 # We don't need OpenSesame for standalone demo mode
 if __name__ != "__main__":
 	from libopensesame import exceptions
-	
-# Don't crash if we fail to load pylink, because we 
-# may still use dummy mode.
-try:
-	import pylink
-	custom_display = pylink.EyeLinkCustomDisplay
-except:
-	custom_display = object
-	print "libeyelink: failed to import pylink"	
 
 import pygame
-from openexp.keyboard import keyboard
-from openexp.mouse import mouse
-from openexp.canvas import canvas
-from openexp.synth import synth
 import os.path
 import array
+import atexit
+import collections
+import importlib
 import math
+import Queue
+import re
 import tempfile
-try:
-	import Image	
-except:
-	from PIL import Image
+import threading
+import timeit
+
+# The time (ms) that it took to import modules, as a {name: time} dict
+_import_times = collections.OrderedDict()
+
+class lazy_module:
+
+	"""
+	A stand-in for a module that is only imported when one of its attributes
+	is first used. This keeps libeyelink quick to load, and means that
+	modules that are only needed for recording or calibration, such as
+	pylink, are never imported in dummy mode.
+	"""
+	
+	def __init__(self, *names):
+	
+		"""
+		Constructor
+
+		Arguments:
+		names -- the name of the module, optionally followed by alternative
+				 names that are tried if the module cannot be imported
+		"""
+		
+		self._names = names
+		self._module = None
+		
+	def _load(self):
+	
+		"""
+		Imports the module, if this hasn't been done yet
+
+		Returns:
+		The module
+		"""
+		
+		if self._module == None:
+			t0 = time.time()
+			for name in self._names[:-1]:
+				try:
+					self._module = importlib.import_module(name)
+					break
+				except ImportError:
+					pass
+			else:
+				self._module = importlib.import_module(self._names[-1])
+			_import_times[self._names[0]] = 1000. * (time.time() - t0)
+		return self._module
+		
+	def __getattr__(self, attr):
+		return getattr(self._load(), attr)
 
-# Don't fail if psychopy isn't available, because we may use others backends
-try:
-	from psychopy import visual				
-except:
-	pass
+# Don't import pylink until it's needed, because we may still use dummy mode.
+pylink = lazy_module("pylink")
+numpy = lazy_module("numpy")
+# Only needed to show the camera image during calibration
+Image = lazy_module("Image", "PIL.Image")
 
 _eyelink = None
+_graphics_env = None
+# The configuration that has been sent over the current connection, as a
+# {name: value} dict (see apply_config())
+_tracker_config = {}
+
+class locked_link:
+
+	"""
+	Gives access to the tracker connection, such that only one thread at a
+	time calls into pylink. This is needed because the asynchronous logging
+	thread sends messages while the main thread, or a background link
+	operation, uses the link. Each call holds the lock only for its own
+	duration, so the lock is never held while waiting for another thread.
+	"""
+	
+	def __init__(self):
+	
+		"""
+		Constructor
+		"""
+		
+		self.lock = threading.RLock()
+		
+	def __getattr__(self, attr):
 	
+		func = getattr(pylink.getEYELINK(), attr)
+		def locked(*args, **kwargs):
+			with self.lock:
+				return func(*args, **kwargs)
+		return locked
+
+# All link calls go through this object (see locked_link)
+_link = locked_link()
+
 class libeyelink:
 
-	MAX_TRY = 100
+	# The maximum time (ms) to keep trying to start recording, and the delay
+	# between attempts: (first delay, growth factor, maximum delay)
+	START_TIMEOUT = 10000
+	START_BACKOFF = 10, 2, 200
+	# The maximum time (ms) to wait for the tracker to stop recording
+	STOP_TIMEOUT = 500
+	# The number of times a message is resent if the link is busy
+	MAX_RESEND = 100
+	# The minimum time (ms) between two status message updates
+	STATUS_INTERVAL = 100
+	# The time (ms) between two reads of the link while the health monitor
+	# is enabled, which keeps the link queue from overflowing
+	DRAIN_INTERVAL = 50
+	# The maximum length of a variable snapshot message
+	MAX_MSG_LEN = 120
 
-	def __init__(self, experiment, resolution, data_file="default.edf", fg_color=(255, 255, 255), bg_color=(0, 0, 0), saccade_velocity_threshold=35, saccade_acceleration_threshold=9500):
+	def __init__(self, experiment, resolution, data_file="default.edf", fg_color=(255, 255, 255), bg_color=(0, 0, 0), saccade_velocity_threshold=35, saccade_acceleration_threshold=9500, background=False):
 
 		"""<DOC>
 		Constructor. Initializes the connection to the Eyelink
@@ -69,13 +159,16 @@ class libeyelink:
 		bg_color -- the background color for the calibration screen (default = 0, 0, 0)
 		saccade_velocity_threshold -- velocity threshold used for saccade detection (default = 35)
 		saccade_acceleration_threshold -- acceleration threshold used for saccade detection (default = 9500)
+		background -- indicates whether the connection should be set up in
+					  the background, so that the experiment can be
+					  prepared in the meantime. The first function that uses
+					  the link waits until the connection is ready (see
+					  wait_for_pending()). (default = False)
 	
 		Returns:
 		True on connection success and False on connection failure       
 		</DOC>"""
 		
-		global _eyelink
-		
 		stem, ext = os.path.splitext(data_file)
 		if len(stem) > 8 or len(ext) > 4:
 			raise exceptions.runtime_error("The Eyelink cannot handle filenames longer than 8 characters (plus .EDF extension)")
@@ -93,73 +186,242 @@ class libeyelink:
 		self.left_eye = 0
 		self.right_eye = 1
 		self.binocular = 2
+		self.gaze_filter = None
+		self.gaze_predictor = None
+		self.drift_correction_status = None
+		self.drift_error = None
+		self.calibration_quality = {}
+		self.start_latency = None
+		self.stop_settle_time = None
+		self._pending = None
+		self._pending_done = None
+		self._pending_kind = None
+		self.realtime_policy = "pylink"
+		self.health_monitor = None
+		self.health_tolerance = 10
+		self._log_queue = None
+		self._log_thread = None
+		self._log_stats = None
+		self._event_backlog = collections.deque(maxlen=1024)
+		self._events_dropped = 0
+		self._drain_thread = None
+		self._drain_stop = None
+		self._realtime_restore = None
+		self.continuous = False
+		self.trial_index = []
+		self._trial_start = None
+		self._prearmed = False
+		self._setup_expected = False
+		self._sample_rate = None
+		self._last_sample_time = None
+		self._last_gaze = None
+		self._status_shown = None
+		self._status_pending = None
+		self._status_time = None
+		self._var_snapshot = {}
+		self._snapshot_msgs = []
+		self.mirror = None
 	
-		# Only initialize the eyelink once		
-		if _eyelink == None:
-			try:
-				_eyelink = pylink.EyeLink()
-			except Exception as e:
-				raise exceptions.runtime_error("Failed to connect to the tracker: %s" % e)
-				
-			graphics_env = eyelink_graphics(self.experiment, _eyelink)
-			pylink.openGraphicsEx(graphics_env)	
-					
-		pylink.getEYELINK().openDataFile(self.data_file)		     
-		pylink.flushGetkeyQueue()
-		pylink.getEYELINK().setOfflineMode()
-		
-		# Notify the eyelink of the display resolution
-		self.send_command("screen_pixel_coords =  0 0 %d %d" % (self.resolution[0], self.resolution[1]))
-
-		# Determine the software version of the tracker
-		self.tracker_software_ver = 0
-		self.eyelink_ver = pylink.getEYELINK().getTrackerVersion()
-		if self.eyelink_ver == 3:
-			tvstr = pylink.getEYELINK().getTrackerVersionString()
-			vindex = tvstr.find("EYELINK CL")
-			self.tracker_software_ver = int(float(tvstr[(vindex + len("EYELINK CL")):].strip()))
-
-		# Set some configuration stuff (not sure what the parser and gazemap mean)
-		if self.eyelink_ver >= 2:
-			self.send_command("select_parser_configuration 0")
-			if self.eyelink_ver == 2: #turn off scenelink camera stuff
-				self.send_command("scene_camera_gazemap = NO")
-		else:
-			self.send_command("saccade_velocity_threshold = %d" % self.saccade_velocity_threshold)
-			self.send_command("saccade_acceleration_threshold = %s" % self.saccade_acceleration_threshold)
+		# Import pylink now, so that the import doesn't count as part of the
+		# connection
+		try:
+			pylink._load()
+		except ImportError as e:
+			raise exceptions.runtime_error("Failed to import pylink: %s" % e)
 	
-		# Set EDF file contents. This specifies which data is written to the EDF file.
-		self.send_command("file_event_filter = LEFT,RIGHT,FIXATION,SACCADE,BLINK,MESSAGE,BUTTON")
-		if self.tracker_software_ver >= 4:
-			self.send_command("file_sample_data  = LEFT,RIGHT,GAZE,AREA,GAZERES,STATUS,HTARGET")
+		# The time (ms) that each step of the connection takes
+		self.startup_times = collections.OrderedDict()
+		self._connect_error = None
+		
+		# The link part of the connection can run in the background, but the
+		# graphics environment is always created from the main thread
+		args = saccade_velocity_threshold, saccade_acceleration_threshold
+		if background:
+			self.start_pending(self.connect, args, self.finish_connect, \
+				"connect")
 		else:
-			self.send_command("file_sample_data  = LEFT,RIGHT,GAZE,AREA,GAZERES,STATUS")
-
-		# Set link data. This specifies which data is sent through the link and thus can
-		# be used in gaze contingent displays
-		self.send_command("link_event_filter = LEFT,RIGHT,FIXATION,SACCADE,BLINK,BUTTON")
-		if self.tracker_software_ver >= 4:
-			self.send_command("link_sample_data  = LEFT,RIGHT,GAZE,GAZERES,AREA,STATUS,HTARGET")
+			self.connect(*args)
+			self.finish_connect()
+			
+	def connect(self, saccade_velocity_threshold=35, saccade_acceleration_threshold=9500):
+	
+		"""<DOC>
+		Connects to the tracker, or reuses the existing connection, opens
+		the data file and configures the tracker. This only uses the link,
+		and can therefore run in the background. Errors are stored and
+		raised by finish_connect().
+		
+		Keyword arguments:
+		saccade_velocity_threshold -- velocity threshold used for saccade detection (default = 35)
+		saccade_acceleration_threshold -- acceleration threshold used for saccade detection (default = 9500)
+		</DOC>"""
+		
+		global _eyelink
+		
+		t = time.time()
+		try:
+			# The connection is kept open across sessions in the same
+			# process, unless it has been lost
+			if _eyelink != None and not connection_alive():
+				print "libeyelink: the connection to the tracker was lost, reconnecting"
+				close_connection()
+			if _eyelink == None:
+				_eyelink = pylink.EyeLink()
+				# This is a new connection, so nothing has been configured yet
+				_tracker_config.clear()
+				t = self.startup_time("connect", t)
+						
+			_link.openDataFile(self.data_file)		     
+			pylink.flushGetkeyQueue()
+			_link.setOfflineMode()
+			t = self.startup_time("data_file", t)
+	
+			# Determine the software version of the tracker
+			self.tracker_software_ver = 0
+			self.eyelink_ver = _link.getTrackerVersion()
+			if self.eyelink_ver == 3:
+				tvstr = _link.getTrackerVersionString()
+				vindex = tvstr.find("EYELINK CL")
+				self.tracker_software_ver = int(float(tvstr[(vindex + len("EYELINK CL")):].strip()))
+			t = self.startup_time("version", t)
+	
+			# Send the configuration, skipping settings that are already in
+			# place. This doesn't use configure(), because that would wait
+			# for this function to finish. Settings are not read back: on a
+			# new connection, reading a setting costs a round trip, whereas
+			# sending it doesn't wait for the tracker, and on a reused
+			# connection _tracker_config already skips them.
+			apply_config(_link, tracker_profile(self.resolution, \
+				self.eyelink_ver, self.tracker_software_ver, \
+				saccade_velocity_threshold, saccade_acceleration_threshold))
+			t = self.startup_time("configure", t)
+		except Exception as e:
+			self._connect_error = e
+			
+	def finish_connect(self):
+	
+		"""<DOC>
+		Completes the connection from the main thread, after connect() has
+		finished, by setting up the graphics environment
+		
+		Exceptions:
+		Raises an exceptions.runtime_error if the connection failed. The
+		error is kept, and raised again by every later function that uses
+		the link (see wait_for_pending()).
+		</DOC>"""
+		
+		global _graphics_env
+		
+		self.check_connect_error()
+		
+		t = time.time()
+		if _graphics_env == None:
+			_graphics_env = eyelink_graphics(self.experiment, _eyelink)
+			pylink.openGraphicsEx(_graphics_env)	
 		else:
-			self.send_command("link_sample_data  = LEFT,RIGHT,GAZE,GAZERES,AREA,STATUS") 
-
-		# Not sure what this means. Maybe the button that is used to end drift correction?
-		self.send_command("button_function 5 'accept_target_fixation'")
+			_graphics_env.set_experiment(self.experiment)
+		t = self.startup_time("graphics", t)
 					
 		if not self.connected():
+			self._connect_error = "not connected"
 			raise exceptions.runtime_error("Failed to connect to the eyetracker")
+		print "libeyelink: startup: %s" % self.startup_report()
+		
+	def check_connect_error(self):
+	
+		"""<DOC>
+		Raises an exceptions.runtime_error if connecting to the tracker has
+		failed, so that the link is not used after a failed background
+		connection
+		</DOC>"""
+		
+		if self._connect_error != None:
+			raise exceptions.runtime_error("Failed to connect to the tracker: %s" % self._connect_error)
+			
+	def startup_time(self, step, t0):
+	
+		"""<DOC>
+		Records how long a step of the connection took
+		
+		Arguments:
+		step -- the name of the step
+		t0 -- the start time of the step, as returned by time.time()
+		
+		Returns:
+		The current time, which is the start time of the next step
+		</DOC>"""
+		
+		t = time.time()
+		self.startup_times[step] = 1000. * (t - t0)
+		return t
+		
+	def startup_report(self):
+	
+		"""<DOC>
+		Returns:
+		A string with the time that loading libeyelink, the imports and each
+		step of the connection took, e.g. 'import pylink 150 ms, ...,
+		connect 812 ms, graphics 35 ms, ..., total 1020 ms'
+		</DOC>"""
+		
+		report = [import_report()]
+		report += ["%s %d ms" % step for step in self.startup_times.items()]
+		report.append("total %d ms" % sum(self.startup_times.values()))
+		return ", ".join(report)
+			
+	def configure(self, commands, readback=False):
+	
+		"""<DOC>
+		Configures the tracker. The commands are sent back to back, and
+		commands that have already been sent over the current connection with
+		the same value are skipped. See tracker_profile() for the default
+		configuration.
+		
+		Arguments:
+		commands -- a list of commands, e.g. ['file_event_filter = LEFT,RIGHT']
+		
+		Keyword arguments:
+		readback -- indicates whether settings of the form 'name = value'
+					that haven't been sent yet should first be read from the
+					tracker, so that they are only sent if they differ. This
+					takes a link round trip per setting. (default = False)
+					
+		Returns:
+		The number of commands that were sent
+		</DOC>"""
+		
+		self.wait_for_pending()
+		
+		if readback:
+			read = self.read_setting
+		else:
+			read = None
+		sent = apply_config(_link, commands, read)
+		if self.mirror != None:
+			for cmd in sent:
+				self.mirror.write("CMD", cmd)
+		return len(sent)
 			
 	
 	def send_command(self, cmd):
 
 		"""<DOC>
-		Sends a command to the eyelink
+		Sends a command to the eyelink. If the command changes a setting
+		('name = value'), this is remembered, so that configure() knows the
+		current value.
 	
 		Arguments:
 		cmd -- the eyelink command to be executed
 		</DOC>"""
+
+		self.wait_for_pending()
 	
-		pylink.getEYELINK().sendCommand(cmd)
+		_link.sendCommand(cmd)
+		key, value, is_setting = split_command(cmd)
+		if is_setting:
+			_tracker_config[key] = value
+		if self.mirror != None:
+			self.mirror.write("CMD", cmd)
 	
 	def log(self, msg):
 
@@ -170,7 +432,7 @@ class libeyelink:
 		msg -- the message to be logged
 		</DOC>"""
 
-		pylink.getEYELINK().sendMessage(msg)
+		self.send_message(msg)
 	
 	def log_var(self, var, val):
 
@@ -183,19 +445,380 @@ class libeyelink:
 		val -- the value
 		</DOC>"""
 
-		pylink.getEYELINK().sendMessage("var %s %s" % (var, val))
+		self.send_message("var %s %s" % (var, val))
+		
+	def send_message(self, msg):
+	
+		"""<DOC>
+		Sends a message to the tracker, either directly or, if asynchronous
+		logging is enabled, through the message queue. All messages pass
+		through this function.
+	
+		Arguments:
+		msg -- the message
+		</DOC>"""
+		
+		if self.mirror != None:
+			self.mirror.write("MSG", msg)
+		if self._log_queue != None:
+			self._log_queue.put((pylink.currentTime(), msg))
+			self._log_stats["max_depth"] = max(self._log_stats["max_depth"], \
+				self._log_queue.qsize())
+			return
+		self.wait_for_pending()
+		_link.sendMessage(msg)
+		
+	def log_batch(self, msgs):
+	
+		"""<DOC>
+		Writes several messages to the eyelink data file, back to back and in
+		order. If the tracker reports that a message could not be sent, it
+		is resent after 1 ms, and messages that are delayed in this way are
+		sent with an offset, so that their EDF timestamp is still the time
+		of the call.
+	
+		Arguments:
+		msgs -- a list of messages
+		</DOC>"""
+		
+		if self._log_queue == None:
+			self.wait_for_pending()
+		self._send_batch(msgs)
+		
+	def _send_batch(self, msgs):
+	
+		"""
+		Sends several messages (see log_batch()), without waiting for a
+		background link operation
+		
+		Arguments:
+		msgs -- a list of messages
+		"""
+		
+		if self._log_queue != None:
+			for msg in msgs:
+				self.send_message(msg)
+			return
+		el = _link
+		t0 = pylink.currentTime()
+		for msg in msgs:
+			if self.mirror != None:
+				self.mirror.write("MSG", msg)
+			for i in range(self.MAX_RESEND):
+				offset = pylink.currentTime() - t0
+				if offset > 0:
+					error = el.sendMessage("%d %s" % (offset, msg))
+				else:
+					error = el.sendMessage(msg)
+				if not error:
+					break
+				pylink.msecDelay(1)
+			else:
+				print "libeyelink.log_batch(): failed to send '%s'" % msg
+	
+	def log_var_snapshot(self, names=None, changed_only=False):
+	
+		"""<DOC>
+		Writes the values of a set of experiment variables to the eyelink
+		data file, packed into as few 'vars' messages as possible. Each
+		message looks like 'vars name=value name="a value" ...' and is at
+		most MAX_MSG_LEN characters long; see pack_var_messages(). This is meant to be called once
+		per trial, after recording has stopped. If the tracker is still
+		being stopped in the background, the messages are sent once it has
+		stopped.
+		
+		Keyword arguments:
+		names -- a list of variable names, or None to use all experiment
+				 variables (default = None)
+		changed_only -- indicates whether only variables that have changed
+						since the last snapshot should be written
+						(default = False)
+		</DOC>"""
+		
+		if names == None:
+			snapshot = [(entry[0], entry[1]) for entry in self.experiment.var_list()]
+		else:
+			snapshot = [(var, self.experiment.get(var)) for var in names \
+				if self.experiment.has(var)]
+		pairs = []
+		for var, val in snapshot:
+			if changed_only and var in self._var_snapshot and self._var_snapshot[var] == val:
+				continue
+			self._var_snapshot[var] = val
+			pairs.append((var, val))
+		msgs = pack_var_messages(pairs, self.MAX_MSG_LEN)
+		# The lock makes sure that the background stop either still sends
+		# these messages, or has already finished (see end_recording())
+		with _link.lock:
+			if self._pending_kind == "stop":
+				self._snapshot_msgs += msgs
+				return
+		self.log_batch(msgs)
+	
+	def set_mirror_log(self, path=None, enabled=True):
+	
+		"""<DOC>
+		Enables or disables a local copy of all messages and commands that
+		are sent to the tracker. This is a tab-separated file with the
+		columns local time (ms), tracker time (ms), type (MSG, CMD or STATUS)
+		and text, which can be followed while the experiment is running.
+		See message_mirror.
+		
+		Keyword arguments:
+		path -- the file to append to, or None to use the name of the EDF
+				file with '_mirror.tsv' instead of '.edf' (default = None)
+		enabled -- indicates whether the mirror log should be enabled
+				   (default = True)
+		</DOC>"""
+		
+		if self.mirror != None:
+			self.mirror.close()
+			self.mirror = None
+		if not enabled:
+			return
+		if path == None:
+			path = os.path.splitext(self.data_file)[0] + "_mirror.tsv"
+		self.mirror = message_mirror(path)
+		print "libeyelink.set_mirror_log(): mirroring messages to %s" % path
+	
+	def compile_message(self, text, item):
+	
+		"""<DOC>
+		Parses a message with [variable] references once, typically in the
+		prepare phase, so that only the variable values need to be filled in
+		when the message is sent. See message_template.
+	
+		Arguments:
+		text -- the message text
+		item -- the item whose variables are used
+		
+		Returns:
+		A message_template
+		</DOC>"""
+		
+		return message_template(text, item)
+	
+	def set_async_logging(self, enabled=True, max_queue=1000):
+	
+		"""<DOC>
+		Enables or disables asynchronous logging. In this mode, log() and
+		log_var() only put the message in a queue, together with the time of
+		the call, and return immediately. A background thread sends the
+		messages to the tracker, prefixed with the time (ms) that has passed
+		since the call. The tracker subtracts this offset from the message
+		timestamp, so that the EDF still reflects the time of the call. If
+		the queue is full, log() waits until there is room. Because pylink
+		is not made to be used from several threads at once, all link calls
+		are serialized (see locked_link). Messages that cannot be sent are
+		counted as failed and skipped.
+		
+		The queue is flushed when recording stops and when the connection is
+		closed. See also flush_log() and log_stats().
+		
+		Keyword arguments:
+		enabled -- indicates whether asynchronous logging should be enabled
+				   (default = True)
+		max_queue -- the maximum number of queued messages (default = 1000)
+		</DOC>"""
+		
+		if self._log_queue != None:
+			self.flush_log()
+			self._log_queue.put(None)
+			self._log_thread.join()
+			self._log_queue = None
+			self._log_thread = None
+		if not enabled:
+			return
+		self._log_stats = {
+			"sent" : 0,
+			"failed" : 0,
+			"max_depth" : 0,
+			"total_latency" : 0,
+			"max_latency" : 0,
+			}
+		self._log_queue = Queue.Queue(max_queue)
+		self._log_thread = threading.Thread(target=self._send_log_queue, \
+			args=(self._log_queue, self._pending))
+		self._log_thread.daemon = True
+		self._log_thread.start()
+		
+	def _send_log_queue(self, queue, pending=None):
+	
+		"""
+		Sends queued messages with an offset timestamp until a None is
+		received. This runs in a background thread.
+		
+		Arguments:
+		queue -- the message queue
+		
+		Keyword arguments:
+		pending -- a background link operation, such as the connection, that
+				   needs to finish before the link can be used, or None
+				   (default = None)
+		"""
+		
+		if pending != None:
+			pending.join()
+		stats = self._log_stats
+		while True:
+			item = queue.get()
+			if item == None:
+				queue.task_done()
+				return
+			t, msg = item
+			# A failure, such as a lost link, must not stop this thread,
+			# otherwise flush_log() would wait forever
+			try:
+				offset = pylink.currentTime() - t
+				if _link.sendMessage("%d %s" % (offset, msg)):
+					raise Exception("the tracker did not accept the message")
+				stats["sent"] += 1
+				stats["total_latency"] += offset
+				stats["max_latency"] = max(stats["max_latency"], offset)
+			except Exception as e:
+				stats["failed"] += 1
+				print "libeyelink._send_log_queue(): failed to send '%s': %s" \
+					% (msg, e)
+			queue.task_done()
+			
+	def flush_log(self):
+	
+		"""<DOC>
+		Waits until all queued messages have been sent
+		</DOC>"""
+		
+		if self._log_queue != None:
+			self._log_queue.join()
+			
+	def log_stats(self):
+	
+		"""<DOC>
+		Returns statistics about asynchronous logging
+		
+		Returns:
+		A dictionary with the number of messages sent and failed, the maximum
+		queue depth, and the mean and maximum time (ms) between the call to log()
+		and the actual sending of the message, or None if asynchronous
+		logging is disabled
+		</DOC>"""
+		
+		if self._log_stats == None:
+			return None
+		stats = self._log_stats.copy()
+		stats["mean_latency"] = float(stats["total_latency"]) / max(1, \
+			stats["sent"])
+		del stats["total_latency"]
+		return stats
 	
-	def status_msg(self, msg):
+	def status_msg(self, msg, immediate=False):
 
 		"""<DOC>
 		Sets the eyelink status message, which is displayed on the 
-		eyelink experimenter pc
+		eyelink experimenter pc. Because commands are slow, the message is
+		not sent right away, but when it doesn't hurt timing: after
+		recording has started or stopped. If the status message is changed
+		several times in between, only the latest message is sent, and
+		nothing is sent if the message is already shown.
 	
 		Arguments:
 		msg -- the status message
+		
+		Keyword arguments:
+		immediate -- indicates whether the message should be sent right
+					 away (default = False)
 		</DOC>"""
+
+		# The status may be sent by a background stop at the same time
+		with _link.lock:
+			if msg == self._status_shown:
+				self._status_pending = None
+			else:
+				self._status_pending = msg
+		if immediate:
+			self.flush_status(force=True)
+			
+	def flush_status(self, force=False):
+	
+		"""<DOC>
+		Sends the latest status message, if it hasn't been sent yet. To keep
+		the link free, at most one status message is sent every
+		STATUS_INTERVAL ms; messages that come in faster are held back until
+		the next flush.
+		
+		Keyword arguments:
+		force -- indicates whether the message should be sent regardless of
+				 the time since the last message (default = False)
+		</DOC>"""
+		
+		if self._status_pending == None:
+			return
+		t = pylink.currentTime()
+		if not force and self._status_time != None and t - self._status_time < self.STATUS_INTERVAL:
+			return
+		self.wait_for_pending()
+		self._send_status()
+		
+	def _send_status(self):
+	
+		"""
+		Sends the latest status message, if any (see flush_status()),
+		without waiting for a background link operation
+		"""
+		
+		with _link.lock:
+			msg = self._status_pending
+			if msg == None:
+				return
+			_link.sendCommand("record_status_message '%s'" % msg)
+			if self.mirror != None:
+				self.mirror.write("STATUS", msg)
+			self._status_shown = msg
+			self._status_pending = None
+			self._status_time = pylink.currentTime()
+	
+	def read_setting(self, name, timeout=100):
+	
+		"""<DOC>
+		Reads the current value of a tracker setting
+		
+		Arguments:
+		name -- the name of the setting, e.g. 'sample_rate'
+		
+		Keyword arguments:
+		timeout -- the maximum time (ms) to wait for a reply (default = 100)
+		
+		Returns:
+		The value as a string, or None if the tracker did not reply in time
+		</DOC>"""
+
+		self.wait_for_pending()
+		
+		_link.readRequest(name)
+		t0 = pylink.currentTime()
+		while pylink.currentTime() - t0 < timeout:
+			reply = _link.readReply()
+			if reply:
+				return reply.strip()
+			pylink.msecDelay(1)
+		print "libeyelink.read_setting(): no reply for '%s'" % name
+		return None
+		
+	def sample_rate(self):
 	
-		pylink.getEYELINK().sendCommand("record_status_message '%s'" % msg)
+		"""<DOC>
+		Returns the sampling rate of the tracker. This is read from the
+		tracker once, and falls back to 1000 Hz if the tracker doesn't reply.
+		
+		Returns:
+		The sampling rate in Hz
+		</DOC>"""
+		
+		if self._sample_rate == None:
+			try:
+				self._sample_rate = float(self.read_setting("sample_rate"))
+			except:
+				self._sample_rate = 1000.
+		return self._sample_rate
 	
 	def connected(self):
 
@@ -205,8 +828,15 @@ class libeyelink:
 		Returns:
 		True if connected, False otherwise
 		</DOC>"""
+
+		try:
+			self.wait_for_pending()
+		except exceptions.runtime_error:
+			if self._connect_error == None:
+				raise
+			return False
 	
-		return pylink.getEYELINK().isConnected()
+		return _link.isConnected()
 		
 	def calibrate(self, beep=True, target_size=16):
 
@@ -220,15 +850,65 @@ class libeyelink:
 		Exceptions:
 		Raises an exceptions.runtime_error on failure		
 		</DOC>"""
+
+		self.wait_for_pending()
+		self.pause_recording()
 	
 		if self.recording:
 			raise exceptions.runtime_error("Trying to calibrate after recording has started")	
 	
+		self.disarm_recording()
 		self.cal_beep = beep
 		self.cal_target_size = target_size
-		pylink.getEYELINK().doTrackerSetup()
+		_graphics_env.quality = {}
+		_link.doTrackerSetup()
+		# The Host screen has changed, so the status message needs to be sent
+		# again
+		self._status_shown = None
+		self.log_calibration_quality()
+		
+	def log_calibration_quality(self):
+	
+		"""<DOC>
+		Stores the results of the last calibration and validation as
+		experiment variables and writes them to the EDF. For both
+		'calibration' and 'validation', the following variables are set, if
+		available:
+		
+		[type]_result -- 'good' or 'failed'
+		[type]_avg_error -- the average error (deg) reported by the tracker
+		[type]_max_error -- the maximum error (deg) reported by the tracker
+		[type]_n_points -- the number of points
+		[type]_point_duration -- the average time (ms) per point
+		[type]_points -- 'x,y,duration' for each point, separated by
+						 semicolons
+		
+		The variables are written to the EDF as 'vars' messages (see
+		log_var_snapshot()). The tracker also writes its own per-point report
+		to the EDF. The results are also available as the
+		calibration_quality dictionary.
+		</DOC>"""
+		
+		self.calibration_quality = _graphics_env.quality
+		for cal_type, q in self.calibration_quality.items():
+			print "libeyelink.log_calibration_quality(): %s" % q["message"]
+			if q["success"]:
+				q["result"] = "good"
+			else:
+				q["result"] = "failed"
+			q["points"] = ";".join(["%d,%d,%d" % tuple(p) for p in \
+				q["point_list"]])
+			pairs = []
+			for var in ("result", "avg_error", "max_error", "n_points", \
+				"point_duration", "points"):
+				if q[var] != None:
+					self.experiment.set("%s_%s" % (cal_type, var), q[var])
+					pairs.append(("%s_%s" % (cal_type, var), q[var]))
+			# The list of points easily exceeds the maximum message length,
+			# so the variables are packed and split (see pack_var_messages())
+			self.log_batch(pack_var_messages(pairs, self.MAX_MSG_LEN))
 	
-	def drift_correction(self, pos=None, fix_triggered=False):
+	def drift_correction(self, pos=None, fix_triggered=False, timeout=None, max_dev=60):
 
 		"""<DOC>
 		Performs drift correction and falls back to the calibration screen if
@@ -240,6 +920,10 @@ class libeyelink:
 		fix_triggered -- a boolean indicating whether drift correction should
 						 be fixation triggered, rather than spacebar triggered
 						 (default = False)
+		timeout -- the maximum duration (ms) of fixation triggered drift
+				   correction, or None to wait indefinitely (default = None)
+		max_dev -- the maximum offset (px) of a fixation that triggers
+				   fixation triggered drift correction (default = 60)
 
 		Returns:
 		True on success, False on failure
@@ -247,12 +931,18 @@ class libeyelink:
 		Exceptions:
 		Raises an exceptions.runtime_error on error
 		</DOC>"""
+
+		self.wait_for_pending()
+		self.pause_recording()
 		
 		if self.recording:
 			raise exceptions.runtime_error("Trying to do drift correction after recording has started")
 
+		self.disarm_recording()
+		self.drift_error = None
 		if fix_triggered:
-			return self.fix_triggered_drift_correction(pos)
+			return self.fix_triggered_drift_correction(pos, max_dev=max_dev, \
+				timeout=timeout)
 
 		if pos == None:
 			pos = self.resolution[0] / 2, self.resolution[1] / 2
@@ -262,27 +952,116 @@ class libeyelink:
 				raise exceptions.runtime_error("The eyelink is not connected")	
 			try:
 				# Params: x, y, draw fix, allow_setup
-				error = pylink.getEYELINK().doDriftCorrect(pos[0], pos[1], 0, 1)
+				error = _link.doDriftCorrect(pos[0], pos[1], 0, 1)
 				if error != 27:
 					print "libeyelink.drift_correction(): success"
+					self.drift_correction_status = "success"
+					self.drift_error = parse_drift_offset( \
+						_link.getCalibrationMessage())
 					return True
 				else:
 					print "libeyelink.drift_correction(): escape pressed"
+					self.drift_correction_status = "aborted"
 					return False
 			except:
 				print "libeyelink.drift_correction(): try again"
+				self.drift_correction_status = "failed"
 				return False
 			
-	def prepare_drift_correction(self, pos):
+	def checked_drift_correction(self, pos=None, fix_triggered=False, accept_threshold=60, recalibrate_threshold=120, max_retries=1, target_canvas=None, timeout=10000, max_dev=None):
 
 		"""<DOC>
-		Puts the tracker in drift correction mode
+		Performs drift correction, and decides what to do based on the
+		measured offset between gaze and the target:
+		
+		- If the offset is at most accept_threshold, drift correction is
+		  accepted.
+		- If the offset is above recalibrate_threshold, the tracker is
+		  recalibrated, after which drift correction is repeated.
+		- Otherwise, drift correction is simply repeated.
+		
+		If drift correction is aborted (e.g., by an accidental press of
+		escape) or times out, it is repeated as well. Only after max_retries
+		repetitions in a row is the tracker recalibrated. If the tracker
+		doesn't report an offset, a successful drift correction is accepted.
+		
+		In fixation triggered mode, a fixation is only used if it is within
+		max_dev of the target. By default, this is twice
+		recalibrate_threshold, so that large offsets are measured as well,
+		rather than waiting for a fixation that never comes.
+		
+		The offset (in pixels) and the decision ('accept', 'retry', or
+		'recalibrate') are stored as the experiment variables drift_error and
+		drift_decision, and are written to the EDF.
 	
-		Arguments:
-		pos -- the reference point
+		Keyword arguments:
+		pos -- the coordinate (x,y tuple) of the drift correction dot or None
+			   for the display center (default = None)
+		fix_triggered -- a boolean indicating whether drift correction should
+						 be fixation triggered, rather than spacebar triggered
+						 (default = False)
+		accept_threshold -- the maximum offset (px) that is accepted
+							(default = 60)
+		recalibrate_threshold -- the offset (px) above which the tracker is
+								 recalibrated (default = 120)
+		max_retries -- the number of repetitions before the tracker is
+					   recalibrated (default = 1)
+		target_canvas -- a canvas with the drift correction target, which is
+						 shown again before drift correction is repeated, or
+						 None (default = None)
+		timeout -- see drift_correction() (default = 10000)
+		max_dev -- see drift_correction(), or None to use twice
+				   recalibrate_threshold (default = None)
+	
+		Returns:
+		True
 	
 		Exceptions:
-		Raises an exceptions.runtime_error on error	
+		Raises an exceptions.runtime_error on error
+		</DOC>"""
+		
+		if max_dev == None:
+			max_dev = 2 * recalibrate_threshold
+		retries = 0
+		while True:
+			success = self.drift_correction(pos, fix_triggered, timeout, \
+				max_dev)
+			error = self.drift_error
+			if success and (error == None or error <= accept_threshold):
+				decision = "accept"
+			elif (error != None and error > recalibrate_threshold) or \
+				retries >= max_retries:
+				decision = "recalibrate"
+			else:
+				decision = "retry"
+			print "libeyelink.checked_drift_correction(): error = %s, %s" \
+				% (error, decision)
+			self.experiment.set("drift_error", error)
+			self.experiment.set("drift_decision", decision)
+			self.log_var("drift_error", error)
+			self.log_var("drift_decision", decision)
+			if decision == "accept":
+				return True
+			if decision == "recalibrate":
+				self.calibrate()
+				retries = 0
+			else:
+				retries += 1
+			# The screen may have been cleared, for example because escape
+			# opened the setup menu, so show the target again
+			if target_canvas != None:
+				target_canvas.show()
+
+	def prepare_drift_correction(self, pos):
+
+		"""<DOC>
+		Puts the tracker in drift correction mode
+	
+		Arguments:
+		pos -- the reference point
+	
+		Exceptions:
+		Raises an exceptions.runtime_error on error	
 		</DOC>"""
 
 		# Start collecting samples in drift correction mode
@@ -292,15 +1071,17 @@ class libeyelink:
 		pylink.msecDelay(50);
 	
 		# Wait for a bit until samples start coming in (I think?)
-		if not pylink.getEYELINK().waitForBlockStart(100, 1, 0):
+		if not _link.waitForBlockStart(100, 1, 0):
 			raise exceptions.runtime_error("Failed to perform drift correction (waitForBlockStart error)")	
 			
-	def fix_triggered_drift_correction(self, pos=None, min_samples=30, max_dev=60, reset_threshold=10):
+	def fix_triggered_drift_correction(self, pos=None, min_samples=30, max_dev=60, reset_threshold=10, timeout=None):
 
 		"""<DOC>
 		Performs fixation triggered drift correction and falls back to the
 		calibration screen if necessary. You can return to the set-up screen by
-		pressing the 'q' key.
+		pressing the 'q' key. Between samples, this function sleeps rather
+		than polling the link continuously. The outcome ('success', 'aborted',
+		or 'timeout') is stored in drift_correction_status.
 	
 		Keyword arguments:
 		pos -- the coordinate (x,y tuple) of the drift correction dot or None
@@ -308,8 +1089,11 @@ class libeyelink:
 		min_samples -- the minimum nr of stable samples that should be acquired
 					   (default = 30)
 		max_dev -- the maximum allowed deviation (default = 60)
-		reset_threshold -- the maximum allowed deviation from one sample to the
-						   next (default = 10)
+		reset_threshold -- the maximum allowed dispersion of the samples, i.e.
+						   the root-mean-square distance from their average
+						   (default = 10)
+		timeout -- the maximum duration (ms) or None to wait indefinitely
+				   (default = None)
 	
 		Returns:
 		True on success, False on failure
@@ -322,136 +1106,656 @@ class libeyelink:
 			raise exceptions.runtime_error("Trying to do drift correction after recording has started")
 		
 		self.recording = True
+		self.reset_sample_state()
 	
 		if pos == None:
 			pos = self.resolution[0] / 2, self.resolution[1] / 2	
 		
+		from openexp.keyboard import keyboard
+		
 		self.prepare_drift_correction(pos)
 		my_keyboard = keyboard(self.experiment, keylist=["escape", "q"], timeout=0)
 		
-		# Loop until we have sufficient samples
-		lx = []
-		ly = []
-		while len(lx) < min_samples:
+		# Loop until the last min_samples samples are stable and close enough
+		# to the target. When there is no new sample, we sleep for half a
+		# sample interval, so that we don't keep a core busy. Because a sleep
+		# can take much longer than requested, all samples that have arrived
+		# in the meantime are read from the link, rather than only the newest.
+		if self.eye_used == None:
+			self.set_eye_used()
+		detector = stability_detector(min_samples, reset_threshold)
+		interval = .5 / self.sample_rate()
+		t0 = pylink.currentTime()
+		while True:
 	
 			# Pressing escape enters the calibration screen	
 			if my_keyboard.get_key()[0] != None:
 				self.recording = False
+				self.drift_correction_status = "aborted"
+				_link.setOfflineMode()
 				print "libeyelink.fix_triggered_drift_correction(): 'q' pressed"
 				return False
+				
+			if timeout != None and pylink.currentTime() - t0 > timeout:
+				self.recording = False
+				self.drift_correction_status = "timeout"
+				_link.setOfflineMode()
+				print "libeyelink.fix_triggered_drift_correction(): timeout"
+				return False
 	
-			# Collect a sample
-			x, y = self.sample()
-		
-			if len(lx) == 0 or x != lx[-1] or y != ly[-1]:
-						
-				# If the current sample deviates too much from the previous one,
-				# reset counting
-				if len(lx) > 0 and (abs(x - lx[-1]) > reset_threshold or abs(y - ly[-1]) > reset_threshold):
-			
-					lx = []
-					ly = []
-			
-				# Collect samples
-				else:		
-		
-					lx.append(x)
-					ly.append(y)			
-			
-	
-			if len(lx) == min_samples:
-	
-				avg_x = sum(lx) / len(lx)
-				avg_y = sum(ly) / len(ly)			
-				d = math.sqrt( (avg_x - pos[0]) ** 2 + (avg_y - pos[1]) ** 2)
+			samples = []
+			self.drain_link(samples)
+			if len(samples) == 0:
+				time.sleep(interval)
+				continue
+			d = None
+			for t, gaze in samples:
+				self._last_sample_time = t
+				self._last_gaze = self.process_sample(t, gaze)
+				detector.update(*self._last_gaze)
+				if detector.stable():
+					avg_x, avg_y = detector.mean()
+					d = math.sqrt( (avg_x - pos[0]) ** 2 + (avg_y - pos[1]) ** 2)
+					if d <= max_dev:
+						break
+					d = None
+			if d == None:
+				continue
+			self.drift_error = d
 	
-				# Emulate a spacebar press on success
-				pylink.getEYELINK().sendKeybutton(32, 0, pylink.KB_PRESS)			
-			
-				# getCalibrationResult() returns 0 on success and an exception
-				# or a non-zero value otherwise
-				result = -1
-				try:
-					result = pylink.getEYELINK().getCalibrationResult()
-				except:
-					lx = []
-					ly = []
-					print "libeyelink.fix_triggered_drift_correction(): try again"
-				if result != 0:
-					lx = []
-					ly = []
-					print "libeyelink.fix_triggered_drift_correction(): try again"
-							
+			# Emulate a spacebar press on success
+			_link.sendKeybutton(32, 0, pylink.KB_PRESS)			
+		
+			# getCalibrationResult() returns 0 on success and an exception
+			# or a non-zero value otherwise
+			result = -1
+			try:
+				result = _link.getCalibrationResult()
+			except:
+				pass
+			if result == 0:
+				break
+			detector.reset()
+			print "libeyelink.fix_triggered_drift_correction(): try again"
 		
 		# Apply drift correction
-		pylink.getEYELINK().applyDriftCorrect()	
+		_link.applyDriftCorrect()	
 		self.recording = False		
+		self.drift_correction_status = "success"
 		
 		print "libeyelink.fix_triggered_drift_correction(): success"
 		
 		return True
 	
-	def start_recording(self):
-
+	def start_tracker(self, timeout=None, backoff=None):
+	
 		"""<DOC>
-		Starts recording of gaze samples
+		Tells the tracker to start recording, and retries with an increasing
+		delay if this fails
+		
+		Keyword arguments:
+		timeout -- the maximum time (ms) to keep trying, or None to use
+				   START_TIMEOUT (default = None)
+		backoff -- a (first delay, growth factor, maximum delay) tuple, or
+				   None to use START_BACKOFF (default = None)
+		
+		Returns:
+		The number of failed attempts
 	
 		Exceptions:
 		Raises an exceptions.runtime_error on failure
 		</DOC>"""
-	
-		self.recording = True
 
+		self.wait_for_pending()
+		
+		if timeout == None:
+			timeout = self.START_TIMEOUT
+		if backoff == None:
+			backoff = self.START_BACKOFF
+		delay, factor, max_delay = backoff
+		t0 = pylink.currentTime()
 		i = 0
 		while True:							
 			# Params: write  samples, write event, send samples, send events
-			error = pylink.getEYELINK().startRecording(1, 1, 1, 1)
+			error = _link.startRecording(1, 1, 1, 1)
 			if not error:
-				break			
-			if i > self.MAX_TRY:
-				raise exceptions.runtime_error("Failed to start recording (startRecording error)")
+				return i
 			i += 1
-			print "libeyelink.start_recording(): failed to start recording (attempt %d of %d)" \
-				% (i, self.MAX_TRY)
-			pylink.msecDelay(100)
+			if pylink.currentTime() - t0 + delay > timeout:
+				raise exceptions.runtime_error("Failed to start recording (startRecording error)")
+			print "libeyelink.start_tracker(): failed to start recording (attempt %d), retrying in %d ms" \
+				% (i, delay)
+			pylink.msecDelay(int(delay))
+			delay = min(delay * factor, max_delay)
+			
+	def prearm_recording(self, timeout=None, backoff=None):
+	
+		"""<DOC>
+		Starts the tracker ahead of time, typically during the prepare phase,
+		so that the next call to start_recording() doesn't have to wait for
+		the tracker. If drift correction or calibration is done in between,
+		the tracker would have to be stopped again, which costs time and
+		leaves an empty recording block in the EDF. Therefore, nothing is
+		done if expect_setup() has been called since the last drift
+		correction or calibration.
+		
+		Keyword arguments:
+		timeout -- see start_tracker()
+		backoff -- see start_tracker()
+	
+		Exceptions:
+		Raises an exceptions.runtime_error on failure
+		</DOC>"""
+		
+		if self.recording or self._prearmed:
+			return
+		if self._setup_expected:
+			print "libeyelink.prearm_recording(): not starting the tracker, because drift correction or calibration comes first"
+			return
+		self.start_tracker(timeout, backoff)
+		self._prearmed = True
+		
+	def expect_setup(self):
+	
+		"""<DOC>
+		Announces that drift correction or calibration will be done before
+		the next recording, typically from the prepare phase of the item that
+		does it. Until then, prearm_recording() does nothing.
+		</DOC>"""
+		
+		self._setup_expected = True
+		
+	def disarm_recording(self):
+	
+		"""<DOC>
+		Stops a tracker that has been started by prearm_recording(). This is
+		done at the start of drift correction and calibration.
+		</DOC>"""
+		
+		self._setup_expected = False
+		if self._prearmed:
+			self._prearmed = False
+			_link.setOfflineMode()
+	
+	def start_recording(self, timeout=None, backoff=None):
+
+		"""<DOC>
+		Starts recording of gaze samples. The time from the call until the
+		first sample arrives is stored as start_latency and as the
+		experiment variable eyelink_start_latency. In continuous recording
+		mode, this only marks the start of a trial if the tracker is already
+		recording.
+		
+		Keyword arguments:
+		timeout -- see start_tracker()
+		backoff -- see start_tracker()
+	
+		Exceptions:
+		Raises an exceptions.runtime_error on failure
+		</DOC>"""
+
+		self.wait_for_pending()
+		
+		if self.continuous and self.recording:
+			self.mark_trial_start()
+			self.flush_status()
+			return
+	
+		t0 = pylink.currentTime()
+		if timeout == None:
+			timeout = self.START_TIMEOUT
+		s = _link.getNewestSample()
+		if s != None:
+			last_sample_time = s.getTime()
+		else:
+			last_sample_time = None
+		
+		self.recording = True
+		self.reset_sample_state()
+		
+		if self._prearmed:
+			self._prearmed = False
+			attempts = 0
+		else:
+			attempts = self.start_tracker(timeout, backoff)
 		
-		# Don't know what this is
-		pylink.pylink.beginRealTimeMode(100)
+		# Raise the priority of the experiment while recording
+		self.begin_realtime()
 
 		# Wait for a bit until samples start coming in (I think?)
-		if not pylink.getEYELINK().waitForBlockStart(100, 1, 0):
+		if not _link.waitForBlockStart(100, 1, 0):
 			raise exceptions.runtime_error("Failed to start recording (waitForBlockStart error)")
+			
+		# Wait for the first sample of this recording
+		interval = .5 / self.sample_rate()
+		while True:
+			s = _link.getNewestSample()
+			if s != None and s.getTime() != last_sample_time:
+				break
+			if pylink.currentTime() - t0 > timeout:
+				raise exceptions.runtime_error("Failed to start recording (no samples)")
+			time.sleep(interval)
+		self.start_latency = pylink.currentTime() - t0
+		self.experiment.set("eyelink_start_latency", self.start_latency)
+		self.experiment.set("eyelink_start_attempts", attempts + 1)
+		if self.continuous:
+			self.mark_trial_start()
+		# The drain thread needs to know which eye to process
+		if self.eye_used == None:
+			self.set_eye_used()
+		if self.health_monitor != None:
+			self._start_drain()
+		# Now that recording is underway, there's time to update the Host
+		self.flush_status()
+			
+	def set_realtime_policy(self, policy):
+	
+		"""<DOC>
+		Determines how the priority of the experiment is raised during
+		recording:
+		
+		'off' -- don't change the priority
+		'pylink' -- use pylink's real-time mode
+		'native' -- raise the process priority and, if that succeeds, pin
+					the process to a single CPU, as far as the operating
+					system permits. This uses psutil if it's available, and
+					os.nice() otherwise.
+		
+		If the priority is currently raised, it is restored first.
+		
+		Use compare_realtime_policies() to check which policy reduces timing
+		variability on a given system.
+		
+		Arguments:
+		policy -- 'off', 'pylink', or 'native'
+		
+		Exceptions:
+		Raises an exceptions.runtime_error if the policy is unknown
+		</DOC>"""
+		
+		if policy not in ("off", "pylink", "native"):
+			raise exceptions.runtime_error("Unknown real-time policy: %s" \
+				% policy)
+		if policy != self.realtime_policy:
+			self.end_realtime()
+		self.realtime_policy = policy
+		
+	def begin_realtime(self):
+	
+		"""<DOC>
+		Raises the priority of the experiment according to the real-time
+		policy
+		</DOC>"""
+		
+		if self.realtime_policy == "pylink":
+			pylink.beginRealTimeMode(100)
+		elif self.realtime_policy == "native" and self._realtime_restore == \
+			None:
+			self._realtime_restore = raise_priority()
+			
+	def end_realtime(self):
+	
+		"""<DOC>
+		Restores the priority of the experiment
+		</DOC>"""
+		
+		if self.realtime_policy == "pylink":
+			pylink.endRealTimeMode()
+		if self._realtime_restore != None:
+			self._realtime_restore()
+			self._realtime_restore = None
+			
+	def compare_realtime_policies(self, duration=500):
+	
+		"""<DOC>
+		Measures timing jitter (see measure_jitter()) under each real-time
+		policy, so that the best policy for a system can be chosen
+		
+		Keyword arguments:
+		duration -- the duration (ms) of each measurement (default = 500)
+		
+		Returns:
+		A dictionary with the policies as keys and the results of
+		measure_jitter() as values
+		</DOC>"""
+		
+		policy = self.realtime_policy
+		results = {}
+		for p in ("off", "pylink", "native"):
+			self.realtime_policy = p
+			self.begin_realtime()
+			results[p] = measure_jitter(duration)
+			self.end_realtime()
+			print "libeyelink.compare_realtime_policies(): %s: %s" % (p, \
+				results[p])
+		self.realtime_policy = policy
+		return results
+			
+	def set_continuous_recording(self, continuous=True):
+	
+		"""<DOC>
+		Enables or disables continuous recording mode. In this mode, the
+		tracker keeps recording across trials, and start_recording() and
+		stop_recording() only mark the start and end of each trial with
+		'trial_start [nr]' and 'trial_end [nr]' messages. The tracker times
+		of these boundaries are collected in trial_index, and are written to
+		a file when the connection is closed (see write_trial_index()).
+		Calibration and drift correction between trials pause the recording,
+		and the next start_recording() resumes it.
+		
+		Keyword arguments:
+		continuous -- indicates whether continuous mode should be enabled
+					  (default = True)
+		</DOC>"""
+		
+		self.continuous = continuous
+		
+	def mark_trial_start(self):
+	
+		"""<DOC>
+		Marks the start of a trial during continuous recording
+		</DOC>"""
+		
+		if self.health_monitor != None:
+			with _link.lock:
+				self.drain_link()
+				self.health_monitor.reset()
+				self._events_dropped = 0
+		self._trial_start = _link.trackerTime()
+		self.log("trial_start %d" % (len(self.trial_index) + 1))
+		self.experiment.set("eyelink_trial_start", self._trial_start)
+		
+	def mark_trial_end(self):
+	
+		"""<DOC>
+		Marks the end of a trial during continuous recording
+		</DOC>"""
+		
+		if self._trial_start == None:
+			return
+		end = _link.trackerTime()
+		nr = len(self.trial_index) + 1
+		self.log("trial_end %d" % nr)
+		self.log_var("trial_duration", end - self._trial_start)
+		self.trial_index.append((nr, self._trial_start, end))
+		self.experiment.set("eyelink_trial_end", end)
+		self._trial_start = None
+		if self.health_monitor != None:
+			self.drain_link()
+			self.report_health()
+		
+	def write_trial_index(self, path=None):
+	
+		"""<DOC>
+		Writes the trial boundaries of continuous recording to a
+		tab-separated file with the columns trial, start, and end (tracker
+		time in ms)
+		
+		Keyword arguments:
+		path -- the file to write to, or None to use the name of the EDF
+				file with '_trials.tsv' instead of '.edf' (default = None)
+		</DOC>"""
+		
+		if path == None:
+			path = os.path.splitext(self.data_file)[0] + "_trials.tsv"
+		f = open(path, "w")
+		f.write("trial\tstart\tend\n")
+		for trial in self.trial_index:
+			f.write("%d\t%d\t%d\n" % trial)
+		f.close()
+		print "libeyelink.write_trial_index(): wrote %s" % path
+		
+	def pause_recording(self):
+	
+		"""<DOC>
+		Stops a continuous recording between trials, for example for drift
+		correction. The next call to start_recording() resumes recording.
+		</DOC>"""
+		
+		if self.continuous and self.recording and self._trial_start == None:
+			self.end_recording()
+		
+	def stop_recording(self, timeout=None, deferred=False):
+	
+		"""<DOC>
+		Stops recording of gaze samples, or, in continuous recording mode,
+		marks the end of a trial. See end_recording().
+		
+		Keyword arguments:
+		timeout -- see end_recording()
+		deferred -- see end_recording()
+		</DOC>"""
 		
-	def stop_recording(self):
+		if self.continuous and self.recording:
+			self.wait_for_pending()
+			self.mark_trial_end()
+			return
+		self.end_recording(timeout, deferred)
+		
+	def end_recording(self, timeout=None, deferred=False):
 
 		"""<DOC>
-		Stop recording of gaze samples
+		Stop recording of gaze samples. This returns as soon as the tracker
+		has left recording mode and the remaining data has been read from
+		the link. The time that this takes is stored as stop_settle_time and
+		as the experiment variable eyelink_stop_settle.
+		
+		In deferred mode, this returns immediately, and the tracker is
+		stopped in the background, for example while the next trial is
+		prepared. Any later function that uses the link first waits until
+		the tracker has stopped (see wait_for_pending()). Because the trial
+		is usually logged before that happens, the results of the recording
+		(see report_recording()) are reported right away, and
+		eyelink_stop_settle is set to 'NA'. The status message and the
+		variable snapshot (see finish_stop()) are sent from the background
+		as soon as the tracker has stopped.
+		
+		Keyword arguments:
+		timeout -- the maximum time (ms) to wait, or None to use STOP_TIMEOUT
+				   (default = None)
+		deferred -- indicates whether the tracker should be stopped in the
+					background (default = False)
 		</DOC>"""
 	
+		self.wait_for_pending()
+		
+		self._stop_drain()
+		if self.health_monitor != None:
+			self.drain_link()
+		self.flush_log()
 		self.recording = False	
+		t0 = pylink.currentTime()
+
+		self.end_realtime()
+		if deferred:
+			self.report_recording()
+			self.experiment.set("eyelink_stop_settle", "NA")
+			self.start_pending(self._deferred_stop, (t0, timeout), \
+				kind="stop")
+		else:
+			self.settle(t0, timeout)
+			self.experiment.set("eyelink_stop_settle", self.stop_settle_time)
+			self.report_recording()
+			self.finish_stop()
+			
+	def settle(self, t0=None, timeout=None):
+	
+		"""<DOC>
+		Puts the tracker in offline mode and waits until it has stopped
+		recording. This is the part of stop_recording() that may run in the
+		background.
+		
+		Keyword arguments:
+		t0 -- see wait_for_offline()
+		timeout -- see wait_for_offline()
+		</DOC>"""
+		
+		if t0 == None:
+			t0 = pylink.currentTime()
+		_link.setOfflineMode()
+		self.wait_for_offline(t0, timeout)
+		self.stop_settle_time = pylink.currentTime() - t0
+		
+	def report_recording(self):
+	
+		"""<DOC>
+		Reports the results of a recording as experiment variables and
+		messages: the health of the recording (see report_health()) and how
+		well gaze prediction has done
+		</DOC>"""
+		
+		self.report_health()
+		if self.gaze_predictor != None and self.gaze_predictor.n_scored > 0:
+			for var, val in self.gaze_predictor.stats().items():
+				self.log_var("prediction_%s" % var, val)
+			self.gaze_predictor.reset_stats()
+	
+	def finish_stop(self):
+	
+		"""<DOC>
+		Sends what has been held back until the tracker has stopped: the
+		status message and the variable snapshot. This doesn't wait for a
+		background link operation, so that it can also be called from the
+		background stop (see end_recording()).
+		</DOC>"""
+	
+		self._send_status()
+		with _link.lock:
+			msgs = self._snapshot_msgs
+			self._snapshot_msgs = []
+		if len(msgs) > 0:
+			self._send_batch(msgs)
+				
+	def _deferred_stop(self, t0, timeout):
+	
+		"""
+		Stops the tracker and sends what has been held back. This runs in
+		the background (see end_recording()).
+		
+		Arguments:
+		t0 -- see settle()
+		timeout -- see settle()
+		"""
+		
+		self.settle(t0, timeout)
+		# From now on, log_var_snapshot() doesn't add to the held back
+		# messages anymore, but waits until this function has finished
+		with _link.lock:
+			self._pending_kind = None
+		self.finish_stop()
 
-		pylink.endRealTimeMode()
-		pylink.getEYELINK().setOfflineMode()
-		pylink.msecDelay(500)   
+	def start_pending(self, target, args=(), done=None, kind=None):
+	
+		"""<DOC>
+		Runs a link operation in the background. Only one such operation can
+		be pending at a time, and functions that use the link wait for it to
+		finish.
+		
+		Arguments:
+		target -- the function to run
+		
+		Keyword arguments:
+		args -- a tuple of arguments for the function (default = ())
+		done -- a function that is called, from the main thread, once the
+				operation has finished, or None (default = None)
+		kind -- a description of the operation, such as 'connect' or 'stop',
+				or None (default = None)
+		</DOC>"""
+		
+		self.wait_for_pending()
+		self._pending_done = done
+		self._pending_kind = kind
+		self._pending = threading.Thread(target=target, args=args)
+		self._pending.start()
+		
+	def wait_for_pending(self):
+	
+		"""<DOC>
+		Waits until a background link operation, if any, has finished
+		
+		Exceptions:
+		Raises an exceptions.runtime_error if connecting to the tracker has
+		failed (see check_connect_error())
+		</DOC>"""
+		
+		if self._pending != None:
+			self._pending.join()
+			self._pending = None
+			done = self._pending_done
+			self._pending_done = None
+			self._pending_kind = None
+			if done != None:
+				done()
+		self.check_connect_error()
+		
+	def wait_for_offline(self, t0=None, timeout=None):
+	
+		"""<DOC>
+		Waits until the tracker has left recording mode, and reads all data
+		that is still on the link, up to the end of the recording block
+		
+		Keyword arguments:
+		t0 -- the time (ms) from which the timeout counts, or None for now
+			  (default = None)
+		timeout -- the maximum time (ms) to wait, or None to use STOP_TIMEOUT
+				   (default = None)
+		
+		Returns:
+		True if the tracker is offline, False on timeout
+		</DOC>"""
+		
+		if t0 == None:
+			t0 = pylink.currentTime()
+		if timeout == None:
+			timeout = self.STOP_TIMEOUT
+		el = _link
+		while True:
+			while el.getNextData() != 0:
+				pass
+			if not el.isInDataBlock(1, 1) and not (el.getCurrentMode() & \
+				pylink.IN_RECORD_MODE):
+				return True
+			if pylink.currentTime() - t0 > timeout:
+				print "libeyelink.wait_for_offline(): timeout"
+				return False
+			pylink.msecDelay(1)
 
 	def close(self):
 
 		"""<DOC>
-		Close the connection with the eyelink
+		Ends the session: closes the data file and transfers it to the
+		experimental pc. The connection itself stays open, so that the next
+		session in the same process can reuse it, and is closed when the
+		process exits (see close_connection()). If connecting to the tracker
+		has failed, there is nothing to close.
 		</DOC>"""
+
+		try:
+			self.wait_for_pending()
+		except exceptions.runtime_error:
+			if self._connect_error == None:
+				raise
+			print "libeyelink.close(): not connected, nothing to close"
+			return
 	
 		if self.recording:
-			self.stop_recording()
+			self.mark_trial_end()
+			self.end_recording()
+		self.disarm_recording()
+		if len(self.trial_index) > 0:
+			self.write_trial_index()
+		if self._log_queue != None:
+			print "libeyelink: asynchronous logging: %s" % self.log_stats()
+			self.set_async_logging(False)
+		self.flush_status(force=True)
+		self.set_mirror_log(enabled=False)
 
 		# Close the datafile and transfer it to the experimental pc
 		print "libeyelink: closing data file"
-		pylink.getEYELINK().closeDataFile()
+		_link.closeDataFile()
 		pylink.msecDelay(100)
 		print "libeyelink: transferring data file"
-		pylink.getEYELINK().receiveDataFile(self.data_file, self.data_file)
-		pylink.msecDelay(100)		
-		print "libeyelink: closing eyelink"
-		pylink.getEYELINK().close();
+		_link.receiveDataFile(self.data_file, self.data_file)
 		pylink.msecDelay(100)		
 	
 	def set_eye_used(self):
@@ -465,7 +1769,7 @@ class libeyelink:
 		Raises an exceptions.runtime_error on failure	
 		<DOC>"""
 
-		self.eye_used = pylink.getEYELINK().eyeAvailable()
+		self.eye_used = _link.eyeAvailable()
 		if self.eye_used == self.right_eye:
 			self.log_var("eye_used", "right")
 		elif self.eye_used == self.left_eye or self.eye_used == self.binocular:
@@ -477,7 +1781,11 @@ class libeyelink:
 	def sample(self):
 
 		"""<DOC>
-		Gets the most recent gaze sample from the eyelink
+		Gets the most recent gaze sample from the eyelink. If a gaze filter
+		has been set (see set_gaze_filter()), the filtered position is
+		returned. Every sample passes through the filter exactly once, so
+		polling faster or slower than the sampling rate does not distort the
+		filter.
 	
 		Returns:
 		A tuple (x, y) containing the coordinates of the sample
@@ -485,59 +1793,394 @@ class libeyelink:
 		Exceptions:
 		Raises an exceptions.runtime_error on failure		
 		</DOC>"""
+
+		self.wait_for_pending()
 	
 		if not self.recording:
 			raise exceptions.runtime_error("Please start recording before collecting eyelink data")
 	
-		if self.eye_used == None:
-			self.set_eye_used()
-		
-		s = pylink.getEYELINK().getNewestSample()
-		if s != None:
-			if self.eye_used == self.right_eye and s.isRightSample():
-				gaze = s.getRightEye().getGaze()
-			elif self.eye_used == self.left_eye and s.isLeftSample():
-				gaze = s.getLeftEye().getGaze()
+		self.poll_sample()
+		if self._last_gaze == None:
+			raise exceptions.runtime_error("No gaze sample is available yet")
+		return self._last_gaze
 		
-		return gaze
+	def poll_sample(self):
 	
-	def wait_for_event(self, event):
-
 		"""<DOC>
-		Waits until an event has occurred
-	
-		Arguments:
-		event -- eyelink event, like pylink.STARTSACC
-	
-		Exceptions:
-		Raises an exceptions.runtime_error on failure			
+		Reads all samples that have arrived on the link and passes each of
+		them, in order, through process_sample(), so that the filter and the
+		predictor see every sample, and not only the newest one at the time
+		of polling. This does not block.
+		
+		Returns:
+		True if a new sample has been processed, False otherwise
 		</DOC>"""
-
-		if not self.recording:
-			raise exceptions.runtime_error("Please start recording before collecting eyelink data")	
-	
+		
 		if self.eye_used == None:
 			self.set_eye_used()
-
-		d = 0
-		while d != event:
-			d = pylink.getEYELINK().getNextData()
+		last_sample_time = self._last_sample_time
+		self.drain_link()
+		return self._last_sample_time != last_sample_time
 		
-		return pylink.getEYELINK().getFloatData()
+	def sample_gaze(self, s):
 	
-	def wait_for_saccade_start(self):
-
 		"""<DOC>
-		Waits for a saccade start
-	
+		Gets the gaze position of the tracked eye from a sample
+		
+		Arguments:
+		s -- a pylink sample
+		
 		Returns:
-		timestamp, start_pos
+		An (x, y) tuple, or None if the sample doesn't contain the tracked eye
+		</DOC>"""
 		
-		Exceptions:
-		Raises an exceptions.runtime_error on failure			
+		if self.eye_used == self.right_eye and s.isRightSample():
+			return s.getRightEye().getGaze()
+		if self.eye_used == self.left_eye and s.isLeftSample():
+			return s.getLeftEye().getGaze()
+		return None
+		
+	def reset_sample_state(self):
+	
+		"""<DOC>
+		Forgets the previous samples, so that the filter and predictor start
+		from scratch. This is done automatically at the start of each
+		recording.
 		</DOC>"""
+		
+		self._last_sample_time = None
+		self._last_gaze = None
+		if self.gaze_filter != None:
+			self.gaze_filter.reset()
+		if self.gaze_predictor != None:
+			self.gaze_predictor.reset()
+		if self.health_monitor != None:
+			self.health_monitor.reset()
+		self._event_backlog.clear()
+		self._events_dropped = 0
+		
+	def process_sample(self, t, gaze):
 	
-		d = self.wait_for_event(pylink.STARTSACC)
+		"""<DOC>
+		Passes a new sample through the processing stage that sits between
+		the link and the consumers of sample(). This is called once for every
+		new sample.
+		
+		Arguments:
+		t -- the sample timestamp in tracker time (ms)
+		gaze -- an (x, y) tuple with the raw gaze position
+		
+		Returns:
+		An (x, y) tuple with the processed gaze position
+		</DOC>"""
+		
+		if self.gaze_predictor != None:
+			self.gaze_predictor.update(t, gaze[0], gaze[1])
+		if self.gaze_filter != None:
+			gaze = self.gaze_filter.update(t, gaze[0], gaze[1])
+		return gaze
+		
+	def set_gaze_filter(self, gaze_filter=None, **kwargs):
+	
+		"""<DOC>
+		Sets the causal filter that is applied to the samples returned by
+		sample(). The available filters, and the latency that they add, are:
+		
+		'moving_average' -- the mean of the last n samples. Adds (n-1)/2
+							samples of latency, e.g. 2 ms for n=5 at 1000 Hz.
+		'exponential' -- exponential smoothing with weight alpha. Adds
+						 (1-alpha)/alpha samples of latency, e.g. 1 ms for
+						 alpha=0.5 at 1000 Hz.
+		'one_euro' -- an adaptive (One Euro) filter that smooths heavily
+					  during fixations and lightly during saccades. Adds about
+					  1/(2*pi*min_cutoff) s of latency when the eyes are
+					  still, dropping towards zero as the eyes speed up.
+		
+		Keyword arguments:
+		gaze_filter -- a filter name, a gaze_filter instance, or None to
+					   disable filtering (default = None)
+		
+		Any other keyword arguments are passed on to the filter constructor
+		(e.g., n=5, alpha=0.5, or min_cutoff=1.0 and beta=0.007)
+		
+		Exceptions:
+		Raises an exceptions.runtime_error if the filter is unknown
+		</DOC>"""
+		
+		if gaze_filter in gaze_filters:
+			gaze_filter = gaze_filters[gaze_filter](**kwargs)
+		elif gaze_filter != None and not isinstance(gaze_filter, \
+			gaze_filter_base):
+			raise exceptions.runtime_error("Unknown gaze filter: %s" \
+				% gaze_filter)
+		self.gaze_filter = gaze_filter
+		self._last_sample_time = None
+		self._last_gaze = None
+		
+	def set_gaze_predictor(self, gaze_predictor=None, **kwargs):
+	
+		"""<DOC>
+		Enables gaze prediction, which allows predict_gaze() to extrapolate
+		the gaze position to a future time. The predictor uses the raw
+		(unfiltered) samples. Because every sample from the link passes
+		through the predictor (see poll_sample()), and not only the samples
+		that happen to be polled, the fit uses consecutive samples, and each
+		prediction is scored against the first sample with a timestamp at or
+		after the predicted time, i.e. at most one sample interval later.
+		The error statistics are written to the EDF when recording stops.
+		
+		Keyword arguments:
+		gaze_predictor -- 'linear', a gaze_predictor instance, or None to
+						  disable prediction (default = None)
+		
+		Any other keyword arguments are passed on to the predictor
+		constructor (e.g., n=5)
+		
+		Exceptions:
+		Raises an exceptions.runtime_error if the predictor is unknown
+		</DOC>"""
+		
+		if gaze_predictor in gaze_predictors:
+			gaze_predictor = gaze_predictors[gaze_predictor](**kwargs)
+		elif gaze_predictor != None and not isinstance(gaze_predictor, \
+			linear_gaze_predictor):
+			raise exceptions.runtime_error("Unknown gaze predictor: %s" \
+				% gaze_predictor)
+		self.gaze_predictor = gaze_predictor
+		
+	def predict_gaze(self, lead):
+	
+		"""<DOC>
+		Predicts where the eyes will be some time from now. This can be used
+		to compensate for display latency in gaze-contingent displays, by
+		passing the time until the display change becomes visible (e.g., the
+		time until the next vertical refresh plus the display's input lag).
+		
+		Arguments:
+		lead -- the time from now (ms) for which gaze should be predicted
+		
+		Returns:
+		A tuple (x, y) containing the predicted gaze position
+		
+		Exceptions:
+		Raises an exceptions.runtime_error on failure
+		</DOC>"""
+		
+		if self.gaze_predictor == None:
+			raise exceptions.runtime_error( \
+				"Please enable gaze prediction with set_gaze_predictor() first")
+		self.sample()
+		# The drain thread may update the predictor at the same time
+		with _link.lock:
+			return self.gaze_predictor.predict(_link.trackerTime() \
+				+ lead)
+	
+	def wait_for_event(self, event):
+
+		"""<DOC>
+		Waits until an event has occurred
+	
+		Arguments:
+		event -- eyelink event, like pylink.STARTSACC
+	
+		Exceptions:
+		Raises an exceptions.runtime_error on failure			
+		</DOC>"""
+
+		self.wait_for_pending()
+
+		if not self.recording:
+			raise exceptions.runtime_error("Please start recording before collecting eyelink data")	
+	
+		if self.eye_used == None:
+			self.set_eye_used()
+			
+		# While the health monitor is enabled, the link is read in the
+		# background (see drain_link()), so events are taken from the backlog
+		# only
+		while True:
+			while len(self._event_backlog) > 0:
+				d, data = self._event_backlog.popleft()
+				if d == event:
+					return data
+			if self.health_monitor == None:
+				break
+			self.drain_link()
+
+		el = _link
+		d = 0
+		while d != event:
+			d = el.getNextData()
+			if d == pylink.SAMPLE_TYPE and self.health_monitor != None:
+				self.health_monitor.update(el.getFloatData().getTime())
+		
+		return el.getFloatData()
+		
+	def set_health_monitor(self, enabled=True, tolerance=10):
+	
+		"""<DOC>
+		Enables or disables the recording health monitor. The monitor checks
+		whether the timestamps of the link samples follow each other at the
+		sampling rate, and counts the gaps and the time lost in them. For
+		this, all data is read from the link, and events are kept for
+		wait_for_event().
+		
+		While recording, the link is read every DRAIN_INTERVAL ms by a
+		background thread, also when the experiment doesn't collect samples.
+		Therefore, the link queue doesn't overflow because of the experiment,
+		and lost data that the link reports (eyelink_lost_data) means that
+		data was really lost between the tracker and the experiment PC.
+		
+		After each recording (or, in continuous mode, each trial), the
+		following experiment variables are set: eyelink_samples,
+		eyelink_gap_count, eyelink_gap_time, eyelink_max_gap,
+		eyelink_lost_data, eyelink_events_dropped, and eyelink_trial_ok
+		('yes' or 'no'). If the time lost exceeds the tolerance, or the link
+		reports lost data, a 'health_warning' message is written to the EDF
+		and eyelink_trial_ok is 'no'. At most 1024 events are kept for
+		wait_for_event(); older events are dropped and counted in
+		eyelink_events_dropped. This doesn't affect eyelink_trial_ok, because
+		the events are still in the EDF.
+		
+		Keyword arguments:
+		enabled -- indicates whether the monitor should be enabled
+				   (default = True)
+		tolerance -- the maximum time (ms) that can be lost per trial
+					 (default = 10)
+		</DOC>"""
+		
+		if enabled:
+			# The sampling rate is only read when recording starts, so that
+			# this doesn't wait for a connection in the background
+			self.health_monitor = recording_monitor(self.sample_rate)
+		else:
+			self.health_monitor = None
+		self.health_tolerance = tolerance
+		
+	def drain_link(self, samples=None):
+	
+		"""<DOC>
+		Reads all data that is waiting on the link. Samples are passed to the
+		health monitor, and events are kept for wait_for_event().
+		
+		Keyword arguments:
+		samples -- a list to which a (timestamp, gaze) tuple is appended for
+				   each sample of the tracked eye, or None to pass these
+				   samples through process_sample() while recording
+				   (default = None)
+		</DOC>"""
+		
+		el = _link
+		# The data type that signals lost link data (not all pylink versions
+		# define it)
+		lost_data = getattr(pylink, "LOST_DATA_EVENT", 0x3F)
+		# This is also called from the drain thread, so the link is locked
+		# for the whole read, so that getFloatData() belongs to getNextData()
+		with el.lock:
+			while True:
+				d = el.getNextData()
+				if d == 0:
+					return
+				if d == pylink.SAMPLE_TYPE:
+					s = el.getFloatData()
+					if self.health_monitor != None:
+						self.health_monitor.update(s.getTime())
+					gaze = self.sample_gaze(s)
+					if gaze == None:
+						continue
+					if samples != None:
+						samples.append((s.getTime(), gaze))
+					elif self.recording:
+						self._last_sample_time = s.getTime()
+						self._last_gaze = self.process_sample( \
+							self._last_sample_time, gaze)
+				elif d == lost_data:
+					if self.health_monitor != None:
+						self.health_monitor.lost_data()
+				else:
+					if len(self._event_backlog) == self._event_backlog.maxlen:
+						self._events_dropped += 1
+					self._event_backlog.append((d, el.getFloatData()))
+					
+	def _start_drain(self):
+	
+		"""Starts reading the link in a background thread"""
+		
+		if self._drain_thread != None:
+			return
+		self._drain_stop = threading.Event()
+		self._drain_thread = threading.Thread(target=self._drain_loop, \
+			args=(self._drain_stop,))
+		self._drain_thread.daemon = True
+		self._drain_thread.start()
+		
+	def _stop_drain(self):
+	
+		"""Stops the thread started by _start_drain(), if any"""
+		
+		if self._drain_thread == None:
+			return
+		self._drain_stop.set()
+		self._drain_thread.join()
+		self._drain_thread = None
+		self._drain_stop = None
+		
+	def _drain_loop(self, stop):
+	
+		"""
+		Reads the link every DRAIN_INTERVAL ms until stop is set. This runs
+		in a background thread.
+		
+		Arguments:
+		stop -- a threading.Event
+		"""
+		
+		while not stop.wait(self.DRAIN_INTERVAL / 1000.):
+			try:
+				self.drain_link()
+			except Exception as e:
+				print "libeyelink._drain_loop(): %s" % e
+				
+	def report_health(self):
+	
+		"""<DOC>
+		Reports the results of the health monitor for the last recording or
+		trial. See set_health_monitor().
+		</DOC>"""
+		
+		if self.health_monitor == None:
+			return
+		with _link.lock:
+			stats = self.health_monitor.stats()
+			dropped = self._events_dropped
+		for var, val in stats.items():
+			self.experiment.set("eyelink_%s" % var, val)
+		self.experiment.set("eyelink_events_dropped", dropped)
+		if dropped > 0:
+			print "libeyelink.report_health(): %d events dropped from the backlog" \
+				% dropped
+		if stats["gap_time"] <= self.health_tolerance and \
+			stats["lost_data"] == 0:
+			self.experiment.set("eyelink_trial_ok", "yes")
+			return
+		self.experiment.set("eyelink_trial_ok", "no")
+		self.log("health_warning samples %(samples)d gaps %(gap_count)d gap_time %(gap_time)d max_gap %(max_gap)d lost_data %(lost_data)d" \
+			% stats)
+		print "libeyelink.report_health(): %s" % stats
+	
+	def wait_for_saccade_start(self):
+
+		"""<DOC>
+		Waits for a saccade start
+	
+		Returns:
+		timestamp, start_pos
+		
+		Exceptions:
+		Raises an exceptions.runtime_error on failure			
+		</DOC>"""
+	
+		d = self.wait_for_event(pylink.STARTSACC)
 		return d.getTime(), d.getStartGaze()
 	
 	def wait_for_saccade_end(self):
@@ -654,6 +2297,8 @@ class libeyelink:
 		prepped_backdrop_image -- an image in the (list x list x tuple) format
 								  required by pylink
 		</DOC>"""
+
+		self.wait_for_pending()
 		
 		if self.experiment.canvas_backend != 'legacy':
 			raise exceptions.runtime_error( \
@@ -663,14 +2308,14 @@ class libeyelink:
 			if	type(prepped_backdrop_image) == list:
 				width = len(prepped_backdrop_image[0])
 				height = len(prepped_backdrop_image)
-				pylink.getEYELINK().bitmapBackdrop(width,height,prepped_backdrop_image,0,0,width,height,0,0,pylink.BX_MAXCONTRAST)
+				_link.bitmapBackdrop(width,height,prepped_backdrop_image,0,0,width,height,0,0,pylink.BX_MAXCONTRAST)
 			else:
 				raise exceptions.runtime_error("Backdrop image has invalid format")
 		else:
 			backdrop = prepare_backdrop(canvas)
 			width = canvas.surface.get_width()
 			height = canvas.surface.get_height()		
-			pylink.getEYELINK().bitmapBackdrop(width,height,backdrop,0,0,width,height,0,0,pylink.BX_MAXCONTRAST)
+			_link.bitmapBackdrop(width,height,backdrop,0,0,width,height,0,0,pylink.BX_MAXCONTRAST)
 		
 class libeyelink_dummy:
 
@@ -691,31 +2336,147 @@ class libeyelink_dummy:
 	def log_var(self, var, val):
 		pass	
 		
-	def status_msg(self, msg):
+	def send_message(self, msg):
+		pass
+		
+	def log_batch(self, msgs):
+		for msg in msgs:
+			self.log(msg)
+			
+	def log_var_snapshot(self, names=None, changed_only=False):
+		pass
+		
+	def set_mirror_log(self, path=None, enabled=True):
+		pass
+			
+	def compile_message(self, text, item):
+		return message_template(text, item)
+		
+	def set_async_logging(self, enabled=True, max_queue=1000):
+		pass
+		
+	def flush_log(self):
+		pass
+		
+	def log_stats(self):
+		return None
+		
+	def status_msg(self, msg, immediate=False):
+		pass
+		
+	def flush_status(self, force=False):
+		pass
+	
+	def read_setting(self, name, timeout=100):
+		return None
+		
+	def connect(self, saccade_velocity_threshold=35, saccade_acceleration_threshold=9500):
+		pass
+		
+	def finish_connect(self):
 		pass
+		
+	def check_connect_error(self):
+		pass
+		
+	def startup_report(self):
+		return "dummy mode, %s" % import_report()
+		
+	def configure(self, commands, readback=False):
+		return 0
+		
+	def sample_rate(self):
+		return 1000.
 	
 	def connected(self):
 		pass
 		
 	def calibrate(self, beep=True, target_size=16):
 		pass
+		
+	def log_calibration_quality(self):
+		pass
 	
-	def drift_correction(self, pos = None, fix_triggered = False):
+	def drift_correction(self, pos = None, fix_triggered = False, timeout = None, max_dev = 60):
+		pygame.time.delay(200)
+		return True
+
+	def checked_drift_correction(self, pos=None, fix_triggered=False, accept_threshold=60, recalibrate_threshold=120, max_retries=1, target_canvas=None, timeout=10000, max_dev=None):
 		pygame.time.delay(200)
 		return True
 
 	def prepare_drift_correction(self, pos):
 		pass
 					
-	def fix_triggered_drift_correction(self, pos = None, min_samples = 30, max_dev = 60, reset_threshold = 10):
+	def fix_triggered_drift_correction(self, pos = None, min_samples = 30, max_dev = 60, reset_threshold = 10, timeout = None):
 		pygame.time.delay(200)
 		return True
 	
-	def start_recording(self):
+	def start_tracker(self, timeout=None, backoff=None):
+		return 0
+		
+	def prearm_recording(self, timeout=None, backoff=None):
+		pass
+		
+	def expect_setup(self):
+		pass
+		
+	def disarm_recording(self):
+		pass
+		
+	def start_recording(self, timeout=None, backoff=None):
+		pass
+		
+	def set_realtime_policy(self, policy):
+		pass
+		
+	def begin_realtime(self):
+		pass
+		
+	def end_realtime(self):
 		pass
 		
-	def stop_recording(self):
+	def compare_realtime_policies(self, duration=500):
+		return {"off" : measure_jitter(duration)}
+		
+	def set_continuous_recording(self, continuous=True):
+		pass
+		
+	def mark_trial_start(self):
+		pass
+		
+	def mark_trial_end(self):
+		pass
+		
+	def write_trial_index(self, path=None):
 		pass
+		
+	def pause_recording(self):
+		pass
+		
+	def stop_recording(self, timeout=None, deferred=False):
+		pass
+		
+	def end_recording(self, timeout=None, deferred=False):
+		pass
+		
+	def settle(self, t0=None, timeout=None):
+		pass
+		
+	def report_recording(self):
+		pass
+		
+	def finish_stop(self):
+		pass
+		
+	def start_pending(self, target, args=(), done=None, kind=None):
+		pass
+		
+	def wait_for_pending(self):
+		pass
+		
+	def wait_for_offline(self, t0=None, timeout=None):
+		return True
 
 	def close(self):
 		pass
@@ -725,10 +2486,40 @@ class libeyelink_dummy:
 
 	def sample(self):
 		return (0,0)
+		
+	def poll_sample(self):
+		return False
+		
+	def sample_gaze(self, s):
+		return None
+		
+	def reset_sample_state(self):
+		pass
+		
+	def process_sample(self, t, gaze):
+		return gaze
+		
+	def set_gaze_filter(self, gaze_filter=None, **kwargs):
+		pass
+		
+	def set_gaze_predictor(self, gaze_predictor=None, **kwargs):
+		pass
+		
+	def predict_gaze(self, lead):
+		return (0,0)
 
 	def wait_for_event(self, event):
 		pass
 		
+	def set_health_monitor(self, enabled=True, tolerance=10):
+		pass
+		
+	def drain_link(self, samples=None):
+		pass
+		
+	def report_health(self):
+		pass
+		
 	def wait_for_saccade_start(self):
 		pygame.time.delay(100)
 		return pygame.time.get_ticks(), (0, 0)	
@@ -759,12 +2550,640 @@ class libeyelink_dummy:
 	def set_backdrop(self, canvas, prepped_backdrop_image=None):
 		pass		
 	
-class eyelink_graphics(custom_display):
+class message_template:
+
+	"""
+	A message with [variable] references that has been parsed in advance.
+	Messages without references are evaluated completely when they are
+	parsed.
+	"""
+	
+	def __init__(self, text, item):
+	
+		"""
+		Constructor
+
+		Arguments:
+		text -- the message text
+		item -- the item whose variables are used
+		"""
+		
+		self.item = item
+		# The odd elements are variable names, the even elements literal text
+		self.parts = re.split(r"\[([_a-zA-Z]+[_a-zA-Z0-9]*)\]", text)
+		if len(self.parts) == 1:
+			self.constant = item.eval_text(text)
+		else:
+			self.constant = None
+			
+	def render(self):
+	
+		"""
+		Returns:
+		The message with the current variable values filled in
+		"""
+		
+		if self.constant != None:
+			return self.constant
+		parts = self.parts[:]
+		for i in range(1, len(parts), 2):
+			parts[i] = "%s" % self.item.get(parts[i])
+		return "".join(parts)
+
+class message_mirror:
+
+	"""
+	An append-only local copy of the messages and commands that are sent to
+	the tracker. Lines are buffered, and the file is synced to disk every
+	SYNC_INTERVAL ms, so that it can be followed while the experiment is
+	running without slowing down the experiment.
+	"""
+	
+	# The time (ms) between two syncs to disk
+	SYNC_INTERVAL = 1000
+	
+	def __init__(self, path):
+	
+		"""
+		Constructor
+
+		Arguments:
+		path -- the file to append to
+		"""
+		
+		self.path = path
+		# Lines can also be written from a background stop. This uses the
+		# link lock, because update_offset() needs it as well.
+		self.lock = _link.lock
+		self.f = open(path, "a", 65536)
+		self.last_sync = pylink.currentTime()
+		self.update_offset()
+		
+	def update_offset(self):
+	
+		"""
+		Determines the difference between the tracker clock and the local
+		clock, so that the tracker time doesn't have to be requested for
+		each line. This goes through the link lock (see locked_link), because
+		other threads may be using the link at the same time. Until the
+		tracker is connected, the offset is unknown.
+		"""
+		
+		if _eyelink == None:
+			self.offset = None
+			return
+		try:
+			self.offset = _link.trackerTimeOffset()
+		except:
+			self.offset = None
+		
+	def write(self, kind, text):
+	
+		"""
+		Appends a line to the file
+
+		Arguments:
+		kind -- the type of line, e.g. 'MSG' or 'CMD'
+		text -- the message or command
+		"""
+		
+		with self.lock:
+			t = pylink.currentTime()
+			if self.offset != None:
+				tracker_t = "%d" % (t + self.offset)
+			else:
+				tracker_t = "NA"
+			self.f.write("%d\t%s\t%s\t%s\n" % (t, tracker_t, kind, \
+				("%s" % text).replace("\n", " ")))
+			if t - self.last_sync >= self.SYNC_INTERVAL:
+				self.sync()
+			
+	def sync(self):
+	
+		"""
+		Writes all buffered lines to disk
+		"""
+		
+		with self.lock:
+			self.f.flush()
+			os.fsync(self.f.fileno())
+			self.last_sync = pylink.currentTime()
+			self.update_offset()
+		
+	def close(self):
+	
+		"""
+		Writes all buffered lines to disk and closes the file
+		"""
+		
+		self.sync()
+		self.f.close()
+
+class recording_monitor:
+
+	"""
+	Checks the continuity of sample timestamps with constant memory: only
+	counters and the last timestamp are kept.
+	"""
+	
+	def __init__(self, rate=1000.):
+	
+		"""
+		Constructor
+
+		Keyword arguments:
+		rate -- the sampling rate (Hz), or a function that returns it. The
+				function is called when the monitor is first reset or
+				updated. (default = 1000.)
+		"""
+		
+		self.rate = rate
+		self.interval = None
+		self.clear()
+		
+	def set_interval(self):
+	
+		"""Determines the sample interval, if this hasn't been done yet"""
+		
+		if self.interval != None:
+			return
+		if callable(self.rate):
+			self.rate = self.rate()
+		self.interval = 1000. / self.rate
+		# Timestamps have a resolution of 1 ms, so at high sampling rates
+		# consecutive samples may differ by up to 1 ms
+		self.threshold = max(1.5 * self.interval, 1.5)
+		
+	def reset(self):
+	
+		"""Start counting from scratch"""
+		
+		self.set_interval()
+		self.clear()
+		
+	def clear(self):
+	
+		"""Sets all counters to zero"""
+		
+		self.last = None
+		self.samples = 0
+		self.gap_count = 0
+		self.gap_time = 0.
+		self.max_gap = 0.
+		self.lost = 0
+		
+	def update(self, t):
+	
+		"""
+		Process a sample timestamp
+
+		Arguments:
+		t -- the timestamp (ms)
+		"""
+		
+		self.set_interval()
+		self.samples += 1
+		if self.last != None and t - self.last > self.threshold:
+			lost = t - self.last - self.interval
+			self.gap_count += 1
+			self.gap_time += lost
+			self.max_gap = max(self.max_gap, lost)
+		self.last = t
+		
+	def lost_data(self):
+	
+		"""Register that the link reported lost data"""
+		
+		self.lost += 1
+		
+	def stats(self):
+	
+		"""
+		Returns:
+		A dictionary with the number of samples, the number of gaps, the
+		total and maximum time lost (ms), and the number of lost-data events
+		"""
+		
+		return {
+			"samples" : self.samples,
+			"gap_count" : self.gap_count,
+			"gap_time" : self.gap_time,
+			"max_gap" : self.max_gap,
+			"lost_data" : self.lost,
+			}
+
+def raise_priority():
+
+	"""
+	Raises the priority of the current process and pins it to a single CPU,
+	as far as the operating system permits. The process is only pinned if
+	its priority has been raised, because otherwise it would compete for
+	the CPU, including with its own background threads, without the
+	priority to win.
+
+	Returns:
+	A function that restores the original priority and affinity
+	"""
+	
+	restore = []
+	try:
+		import psutil
+	except ImportError:
+		psutil = None
+	if psutil != None:
+		p = psutil.Process(os.getpid())
+		try:
+			nice = p.nice()
+			if os.name == "nt":
+				p.nice(psutil.HIGH_PRIORITY_CLASS)
+			else:
+				p.nice(-10)
+			restore.append(lambda: p.nice(nice))
+		except Exception as e:
+			print "libeyelink.raise_priority(): failed to set priority: %s" % e
+		if len(restore) > 0:
+			try:
+				affinity = p.cpu_affinity()
+				p.cpu_affinity([affinity[-1]])
+				restore.append(lambda: p.cpu_affinity(affinity))
+			except Exception as e:
+				print "libeyelink.raise_priority(): failed to set affinity: %s" \
+					% e
+	elif hasattr(os, "nice"):
+		try:
+			os.nice(-10)
+			# Lowering the priority is always permitted
+			restore.append(lambda: os.nice(10))
+		except OSError as e:
+			print "libeyelink.raise_priority(): failed to set priority: %s" % e
+	
+	def _restore():
+		for f in restore:
+			try:
+				f()
+			except Exception as e:
+				print "libeyelink.raise_priority(): failed to restore: %s" % e
+	return _restore
+	
+def measure_jitter(duration=500, interval=1):
+
+	"""
+	Measures how accurately the experiment can wake up at regular intervals,
+	which reflects the timing variability that the system introduces
+
+	Keyword arguments:
+	duration -- the duration of the measurement (ms) (default = 500)
+	interval -- the intended interval between wake-ups (ms) (default = 1)
+
+	Returns:
+	A dictionary with the mean, standard deviation, and maximum of the
+	actual intervals (ms)
+	"""
+	
+	# time.time() has a resolution of about 15 ms on Windows, so this uses
+	# the most precise clock of the platform (time.clock() on Windows).
+	# This doesn't need pylink, so that it also works in dummy mode.
+	clock = timeit.default_timer
+	n = 0
+	total = 0.
+	total2 = 0.
+	longest = 0.
+	t0 = t = clock()
+	while (t - t0) * 1000 < duration:
+		time.sleep(interval / 1000.)
+		t1 = clock()
+		d = (t1 - t) * 1000
+		t = t1
+		n += 1
+		total += d
+		total2 += d ** 2
+		longest = max(longest, d)
+	mean = total / n
+	return {
+		"mean" : mean,
+		"sd" : math.sqrt(max(0., total2 / n - mean ** 2)),
+		"max" : longest,
+		}
+
+def parse_drift_offset(msg):
+
+	"""
+	Extracts the offset from the message that the tracker reports after
+	drift correction, which looks like '... OFFSET 0.33 deg. 11.2,-5.1 pix.'
+
+	Arguments:
+	msg -- the message
+
+	Returns:
+	The offset in pixels, or None if the message doesn't contain an offset
+	"""
+	
+	if msg == None:
+		return None
+	m = re.search(r"([-\d.]+)\s*,\s*([-\d.]+)\s*pix", msg)
+	if m == None:
+		return None
+	try:
+		return math.sqrt(float(m.group(1)) ** 2 + float(m.group(2)) ** 2)
+	except ValueError:
+		return None
+
+def connection_alive():
+
+	"""
+	Checks whether the connection to the tracker is still open, without a
+	round trip over the link
+
+	Returns:
+	True if the connection is open, False otherwise
+	"""
+	
+	try:
+		return bool(_eyelink.isConnected())
+	except:
+		return False
+
+def close_connection():
+
+	"""
+	Closes the connection to the tracker, if it is open. This happens
+	automatically when the process exits.
+	"""
+	
+	global _eyelink, _graphics_env
+	
+	if _eyelink == None:
+		return
+	print "libeyelink: closing eyelink"
+	try:
+		_eyelink.close()
+	except Exception as e:
+		print "libeyelink.close_connection(): %s" % e
+	_eyelink = None
+	_graphics_env = None
+	
+atexit.register(close_connection)
+
+def import_report():
+
+	"""
+	Returns:
+	A string with the time that loading libeyelink and the imports that
+	have been done so far took, e.g. 'load libeyelink 20 ms, import pylink
+	150 ms'
+	"""
+	
+	return ", ".join(["load libeyelink %d ms" % _load_time] + \
+		["import %s %d ms" % item for item in _import_times.items()])
+
+def tracker_profile(resolution, eyelink_ver, tracker_software_ver, saccade_velocity_threshold=35, saccade_acceleration_threshold=9500):
+
+	"""
+	Gives the configuration commands that are sent when connecting
+
+	Arguments:
+	resolution -- (width, height) tuple
+	eyelink_ver -- the tracker version
+	tracker_software_ver -- the tracker software version
+
+	Keyword arguments:
+	saccade_velocity_threshold -- velocity threshold used for saccade
+								  detection (default = 35)
+	saccade_acceleration_threshold -- acceleration threshold used for
+									  saccade detection (default = 9500)
+
+	Returns:
+	A list of commands
+	"""
+	
+	# Notify the eyelink of the display resolution
+	profile = ["screen_pixel_coords = 0 0 %d %d" % (resolution[0], resolution[1])]
+	
+	# Set some configuration stuff (not sure what the parser and gazemap mean)
+	if eyelink_ver >= 2:
+		profile.append("select_parser_configuration 0")
+		if eyelink_ver == 2: #turn off scenelink camera stuff
+			profile.append("scene_camera_gazemap = NO")
+	else:
+		profile.append("saccade_velocity_threshold = %d" % saccade_velocity_threshold)
+		profile.append("saccade_acceleration_threshold = %s" % saccade_acceleration_threshold)
+		
+	# Set EDF file contents. This specifies which data is written to the EDF
+	# file.
+	profile.append("file_event_filter = LEFT,RIGHT,FIXATION,SACCADE,BLINK,MESSAGE,BUTTON")
+	if tracker_software_ver >= 4:
+		profile.append("file_sample_data = LEFT,RIGHT,GAZE,AREA,GAZERES,STATUS,HTARGET")
+	else:
+		profile.append("file_sample_data = LEFT,RIGHT,GAZE,AREA,GAZERES,STATUS")
+		
+	# Set link data. This specifies which data is sent through the link and
+	# thus can be used in gaze contingent displays
+	profile.append("link_event_filter = LEFT,RIGHT,FIXATION,SACCADE,BLINK,BUTTON")
+	if tracker_software_ver >= 4:
+		profile.append("link_sample_data = LEFT,RIGHT,GAZE,GAZERES,AREA,STATUS,HTARGET")
+	else:
+		profile.append("link_sample_data = LEFT,RIGHT,GAZE,GAZERES,AREA,STATUS")
+		
+	# Not sure what this means. Maybe the button that is used to end drift
+	# correction?
+	profile.append("button_function 5 'accept_target_fixation'")
+	return profile
+	
+def split_command(cmd):
+
+	"""
+	Splits a command into a key and a value. For settings, such as
+	'file_sample_data = LEFT,RIGHT', the key is the name of the setting. For
+	other commands, such as "button_function 5 'accept_target_fixation'",
+	the key is the entire command.
+
+	Arguments:
+	cmd -- the command
+
+	Returns:
+	A (key, value, is_setting) tuple
+	"""
+	
+	cmd = " ".join(cmd.split())
+	if "=" in cmd:
+		name, value = cmd.split("=", 1)
+		return name.strip(), value.strip(), True
+	return cmd, None, False
+
+def apply_config(tracker, commands, read=None):
+
+	"""
+	Sends configuration commands back to back, skipping those that have
+	already been sent over the current connection
+
+	Arguments:
+	tracker -- an eyelink instance
+	commands -- a list of commands
+
+	Keyword arguments:
+	read -- a function that reads a setting from the tracker, or None to
+			not read settings (default = None)
+
+	Returns:
+	A list of the commands that were sent
+	"""
+	
+	sent = []
+	for cmd in commands:
+		key, value, is_setting = split_command(cmd)
+		if key in _tracker_config and _tracker_config[key] == value:
+			continue
+		if is_setting and read != None and key not in _tracker_config:
+			current = read(key)
+			if current != None and "".join(current.split()).upper() == \
+				"".join(value.split()).upper():
+				_tracker_config[key] = value
+				continue
+		tracker.sendCommand(cmd)
+		_tracker_config[key] = value
+		sent.append(cmd)
+	return sent
+
+def pack_var_messages(pairs, max_len=120):
+
+	"""
+	Packs variables into as few 'vars name=value ...' messages as possible.
+	Values that contain spaces, quotes or '=' are quoted, with '\' and '"'
+	escaped by a backslash. A value that doesn't fit into a single message
+	is split into quoted parts, which are sent as 'name="part1"' followed
+	by 'name+="part2"', etc., possibly in the next messages.
+
+	Arguments:
+	pairs -- a list of (name, value) tuples
+
+	Keyword arguments:
+	max_len -- the maximum length of a message (default = 120)
+
+	Returns:
+	A list of messages
+	"""
+	
+	msgs = []
+	msg = "vars"
+	for var, val in pairs:
+		val = "%s" % val
+		if val == "" or re.search(r"[\s\"=]", val) != None:
+			field = ' %s="%s"' % (var, escape_var_value(val))
+		else:
+			field = " %s=%s" % (var, val)
+		if len("vars") + len(field) <= max_len:
+			fields = [field]
+		else:
+			fields = split_var_value(var, val, max_len - len("vars"))
+		for field in fields:
+			if len(msg) + len(field) > max_len and msg != "vars":
+				msgs.append(msg)
+				msg = "vars"
+			msg += field
+	if msg != "vars":
+		msgs.append(msg)
+	return msgs
+	
+def escape_var_value(val):
+
+	"""
+	Arguments:
+	val -- a value
+
+	Returns:
+	The value with '\' and '"' escaped by a backslash
+	"""
+	
+	return val.replace("\\", "\\\\").replace('"', '\\"')
+	
+def split_var_value(var, val, max_len):
+
+	"""
+	Splits a long value into quoted parts (see pack_var_messages()). The
+	value is split before escaping, so that no part ends in the middle of
+	an escape sequence.
+
+	Arguments:
+	var -- the variable name
+	val -- the value
+	max_len -- the maximum length of a part, including the name
+
+	Returns:
+	A list of fields, e.g. [' name="part1"', ' name+="part2"']
+	"""
+	
+	# Leave room for the name, '+=' and the quotes
+	room = max(2, max_len - len(var) - 5)
+	fields = []
+	op = "="
+	part = ""
+	for c in val:
+		c = escape_var_value(c)
+		if len(part) + len(c) > room:
+			fields.append(' %s%s"%s"' % (var, op, part))
+			op = "+="
+			part = ""
+		part += c
+	fields.append(' %s%s"%s"' % (var, op, part))
+	return fields
+
+def parse_calibration_quality(msg):
+
+	"""
+	Extracts the average and maximum error from the message that the tracker
+	reports after calibration or validation, which looks like
+	'... ERROR 0.45 avg. 0.95 max ...'
+
+	Arguments:
+	msg -- the message
+
+	Returns:
+	An (average, maximum) tuple in degrees, with None for missing values
+	"""
+	
+	if msg == None:
+		return None, None
+	m = re.search(r"([\d.]+)\s*avg\.?\s*([\d.]+)\s*max", msg)
+	if m == None:
+		return None, None
+	try:
+		return float(m.group(1)), float(m.group(2))
+	except ValueError:
+		return None, None
+	
+# The graphics environment class, which is created by eyelink_graphics()
+_graphics_class = None
+
+def eyelink_graphics(experiment, tracker):
+
+	"""
+	Creates the graphics environment. The class combines opensesame_graphics
+	with pylink.EyeLinkCustomDisplay, and is therefore only created once
+	pylink is needed.
+
+	Arguments:
+	experiment -- opensesame experiment
+	tracker -- an eyelink instance
+
+	Returns:
+	A graphics environment
+	"""
+	
+	global _graphics_class
+	
+	if _graphics_class == None:
+		class graphics_env(opensesame_graphics, pylink.EyeLinkCustomDisplay):
+			pass
+		_graphics_class = graphics_env
+	return _graphics_class(experiment, tracker)
+
+class opensesame_graphics:
 
 	"""
 	A custom graphics environment to provide calibration functionality using
 	OpenSesame, rather than PyLinks built-in system. Derived from the examples
-	provided with PyLink
+	provided with PyLink. This is used together with
+	pylink.EyeLinkCustomDisplay; see eyelink_graphics().
 	"""
 	
 	fgcolor = 255, 255, 255, 255
@@ -773,15 +3192,47 @@ class eyelink_graphics(custom_display):
 	def __init__(self, experiment, tracker):
 	
 		"""
-		Constructor
+		Constructor
+
+		Arguments:
+		experiment -- opensesame experiment
+		tracker -- an eyelink instance
+		"""
+		
+		pylink.EyeLinkCustomDisplay.__init__(self)
+
+		self.set_experiment(experiment)
+		self.state = None
+		
+		# The targets of the current calibration or validation, as
+		# [x, y, onset, duration] lists, and the results of the last
+		# calibration and validation
+		self.cal_points = []
+		self.quality = {}
+		
+		self.imagebuffer = array.array('l')
+		self.pal = None	
+		self.size = (0,0)		
+		self.tmp_file = os.path.join(tempfile.gettempdir(), '__eyelink__.jpg')
+					
+		self.set_tracker(tracker)
+		self.last_mouse_state = -1	
+		
+	def set_experiment(self, experiment):
+	
+		"""
+		Connect the graphics environment to an experiment. This is also used
+		when the connection to the tracker is reused for a new session.
 
 		Arguments:
 		experiment -- opensesame experiment
-		tracker -- an eyelink instance
 		"""
 		
-		pylink.EyeLinkCustomDisplay.__init__(self)
-
+		from openexp.keyboard import keyboard
+		from openexp.mouse import mouse
+		from openexp.canvas import canvas
+		from openexp.synth import synth
+		
 		self.experiment = experiment
 		self.my_canvas = canvas(self.experiment)
 		self.my_keyboard = keyboard(self.experiment, timeout=0)
@@ -791,16 +3242,10 @@ class eyelink_graphics(custom_display):
 		self.__target_beep__done__ = synth(self.experiment, freq = 880, length = 200)
 		self.__target_beep__error__ = synth(self.experiment, freq = 220, length = 200)
 		
-		self.state = None
-		
-		self.imagebuffer = array.array('l')
-		self.pal = None	
-		self.size = (0,0)		
-		self.tmp_file = os.path.join(tempfile.gettempdir(), '__eyelink__.jpg')
-					
-		self.set_tracker(tracker)
-		self.last_mouse_state = -1	
-		
+		# Pre-rendered canvases for calibration targets and text screens
+		self.target_cache = {}
+		self.screen_cache = {}
+	
 	def set_tracker(self, tracker):
 	
 		"""
@@ -813,35 +3258,59 @@ class eyelink_graphics(custom_display):
 		self.tracker = tracker
 		self.tracker_version = tracker.getTrackerVersion()
 		if(self.tracker_version >=3):
-			self.tracker.sendCommand("enable_search_limits=YES")
-			self.tracker.sendCommand("track_search_limits=YES")
-			self.tracker.sendCommand("autothreshold_click=YES")
-			self.tracker.sendCommand("autothreshold_repeat=YES")
-			self.tracker.sendCommand("enable_camera_position_detect=YES")			
+			apply_config(self.tracker, [
+				"enable_search_limits=YES",
+				"track_search_limits=YES",
+				"autothreshold_click=YES",
+				"autothreshold_repeat=YES",
+				"enable_camera_position_detect=YES",
+				])
+
+	def cached_screen(self, name, lines):
+	
+		"""
+		Get a canvas with a few lines of text, which is rendered only the
+		first time that it is requested
+
+		Arguments:
+		name -- a name that identifies the screen
+		lines -- a list of (text, y offset from the center) tuples
+
+		Returns:
+		An openexp canvas
+		"""
+		
+		key = name, self.experiment.foreground, self.experiment.background
+		if key not in self.screen_cache:
+			from openexp.canvas import canvas
+			c = canvas(self.experiment)
+			yc = c.ycenter()
+			for text, dy in lines:
+				c.text(text, y = yc + dy)
+			self.screen_cache[key] = c
+		return self.screen_cache[key]
 
 	def setup_cal_display (self):
 	
 		"""Setup the calibration display, which contains some instructions"""
 	
-		yc = self.my_canvas.ycenter()
 		ld = 40
-		self.my_canvas.clear()		
-		self.my_canvas.text("OpenSesame eyelink plug-in", y = yc - 5 * ld)
-		self.my_canvas.text("Enter: Enter camera set-up", y = yc - 3 * ld)
-		self.my_canvas.text("C: Calibration", y = yc - 2 * ld)
-		self.my_canvas.text("V: Validation", y = yc - 1 * ld)
-		self.my_canvas.text("Q: Exit set-up", y = yc - 0 * ld)
-		self.my_canvas.text("A: Automatically adjust threshold", y = yc + 1 * ld)
-		self.my_canvas.text("Up/ Down: Adjust threshold", y = yc + 2 * ld)
-		self.my_canvas.text("Left/ Right: Switch camera view", y = yc + 3 * ld)		
-		self.my_canvas.show()
+		self.cached_screen("setup", [
+			("OpenSesame eyelink plug-in", -5 * ld),
+			("Enter: Enter camera set-up", -3 * ld),
+			("C: Calibration", -2 * ld),
+			("V: Validation", -1 * ld),
+			("Q: Exit set-up", 0 * ld),
+			("A: Automatically adjust threshold", 1 * ld),
+			("Up/ Down: Adjust threshold", 2 * ld),
+			("Left/ Right: Switch camera view", 3 * ld),
+			]).show()
 				
 	def exit_cal_display(self): 
 	
 		"""Clear the display"""
 	
-		self.my_canvas.clear()
-		self.my_canvas.show()
+		self.cached_screen("blank", []).show()
 		
 	def record_abort_hide(self):
 
@@ -853,9 +3322,7 @@ class eyelink_graphics(custom_display):
 	
 		"""Clear the display"""
 		
-		self.my_canvas.clear()		
-		self.my_canvas.show()
-		
+		self.cached_screen("blank", []).show()
 		
 	def erase_cal_target(self):
 	
@@ -866,21 +3333,101 @@ class eyelink_graphics(custom_display):
 	def draw_cal_target(self, x, y): 
 	
 		"""
-		Draw the calibration target
+		Draw the calibration target. Each target is rendered only the first
+		time that it is shown at a particular position, size, and color.
 
 		Arguments:
 		x -- the x-coordinate of the target
 		y -- the y-coordinate of the target
 		"""
 		
-		self.my_canvas.clear()
-		
-		self.my_canvas.circle(x, y, r=self.experiment.eyelink.cal_target_size, fill=True)
-		self.my_canvas.circle(x, y, r=2, color=self.experiment.background, fill=True)
-		self.my_canvas.show()
+		size = self.experiment.eyelink.cal_target_size
+		key = x, y, size, self.experiment.foreground, \
+			self.experiment.background
+		if key not in self.target_cache:
+			from openexp.canvas import canvas
+			c = canvas(self.experiment)
+			c.circle(x, y, r=size, fill=True)
+			c.circle(x, y, r=2, color=self.experiment.background, fill=True)
+			self.target_cache[key] = c
+		self.target_cache[key].show()
+		self.update_state()
+		self.record_cal_point(x, y)
 		if self.experiment.eyelink.cal_beep:
 			self.play_beep(pylink.CAL_TARG_BEEP)
 		
+	def update_state(self):
+	
+		"""
+		Determine from the tracker mode whether a calibration or validation
+		is running, so that also runs that are started from the Host PC are
+		recorded. A new run starts with an empty list of targets.
+		"""
+		
+		try:
+			mode = self.tracker.getTrackerMode()
+		except:
+			return
+		if mode == getattr(pylink, "EL_CALIBRATE_MODE", 10):
+			state = "calibration"
+		elif mode == getattr(pylink, "EL_VALIDATE_MODE", 11):
+			state = "validation"
+		else:
+			state = None
+		if state != self.state:
+			self.cal_points = []
+		self.state = state
+		
+	def record_cal_point(self, x, y):
+	
+		"""
+		Keep track of the calibration targets and how long each was shown
+
+		Arguments:
+		x -- the x-coordinate of the target
+		y -- the y-coordinate of the target
+		"""
+		
+		t = pylink.currentTime()
+		if len(self.cal_points) > 0:
+			self.cal_points[-1][3] = t - self.cal_points[-1][2]
+		self.cal_points.append([x, y, t, 0])
+		
+	def finish_cal_run(self, success):
+	
+		"""
+		Store the results of a calibration or validation
+
+		Arguments:
+		success -- indicates whether the tracker accepted the result
+		"""
+		
+		if self.state not in ("calibration", "validation"):
+			return
+		if len(self.cal_points) > 0:
+			self.cal_points[-1][3] = pylink.currentTime() - \
+				self.cal_points[-1][2]
+		try:
+			msg = self.tracker.getCalibrationMessage()
+		except:
+			msg = None
+		avg_error, max_error = parse_calibration_quality(msg)
+		n = len(self.cal_points)
+		if n > 0:
+			duration = sum([p[3] for p in self.cal_points]) / float(n)
+		else:
+			duration = None
+		self.quality[self.state] = {
+			"message" : msg,
+			"success" : success,
+			"avg_error" : avg_error,
+			"max_error" : max_error,
+			"n_points" : n,
+			"point_duration" : duration,
+			"point_list" : [(p[0], p[1], p[3]) for p in self.cal_points],
+			}
+		self.cal_points = []
+		
 	def play_beep(self, beepid):
 	
 		"""
@@ -893,22 +3440,29 @@ class eyelink_graphics(custom_display):
 		if beepid == pylink.CAL_TARG_BEEP:
 			self.__target_beep__.play()
 		elif beepid == pylink.CAL_ERR_BEEP or beepid == pylink.DC_ERR_BEEP:			
-			self.my_canvas.clear()
-			self.my_canvas.text("Calibration unsuccessfull", y = self.my_canvas.ycenter() - 20)
-			self.my_canvas.text("Press 'Enter' to return to menu", y = self.my_canvas.ycenter() + 20)
-			self.my_canvas.show()
+			if beepid == pylink.CAL_ERR_BEEP:
+				self.finish_cal_run(False)
+			self.cached_screen("error", [
+				("Calibration unsuccessfull", -20),
+				("Press 'Enter' to return to menu", 20),
+				]).show()
 			self.__target_beep__error__.play()
 		elif beepid == pylink.CAL_GOOD_BEEP:				
-			self.my_canvas.clear()			
+			self.finish_cal_run(True)
 			if self.state == "calibration":
-				self.my_canvas.text("Success!", y = self.my_canvas.ycenter() - 20)			
-				self.my_canvas.text("Press 'v' to validate", y = self.my_canvas.ycenter() + 20)
+				self.cached_screen("calibration", [
+					("Success!", -20),
+					("Press 'v' to validate", 20),
+					]).show()
 			elif self.state == "validation":
-				self.my_canvas.text("Success!", y = self.my_canvas.ycenter() - 20)						
-				self.my_canvas.text("Press 'Enter' to return to menu", y = self.my_canvas.ycenter() + 20)							
+				self.cached_screen("validation", [
+					("Success!", -20),
+					("Press 'Enter' to return to menu", 20),
+					]).show()
 			else:
-				self.my_canvas.text("Press 'Enter' to return to menu")
-			self.my_canvas.show()			
+				self.cached_screen("done", [
+					("Press 'Enter' to return to menu", 0),
+					]).show()
 			self.__target_beep__done__.play()			
 		else: #	DC_GOOD_BEEP	or DC_TARG_BEEP
 			pass
@@ -967,10 +3521,10 @@ class eyelink_graphics(custom_display):
 			self.state = None		
 		elif key == "c":
 			keycode = ord("c")
-			self.state = "calibration"
+			self.cal_points = []
 		elif key == "v":
 			keycode = ord("v")
-			self.state = "validation"
+			self.cal_points = []
 		elif key == "a":
 			keycode = ord("a")			
 		elif key == "up":
@@ -1065,3 +3619,581 @@ class eyelink_graphics(custom_display):
 			self.pal.append((rf<<16) | (gf<<8) | (bf))
 			i = i+1		
 				
+
+class gaze_filter_base:
+
+	"""
+	Base class for causal gaze filters. Filters only look at the current and
+	past samples, so they can be applied online. All state is kept in
+	buffers that are allocated once, so update() has a constant cost per
+	sample. The batch() function filters whole arrays at once and continues
+	from (and updates) the same state as update().
+	"""
+	
+	def reset(self):
+	
+		"""Forget all previous samples"""
+		
+		pass
+		
+	def update(self, t, x, y):
+	
+		"""
+		Filter a single sample
+
+		Arguments:
+		t -- the sample timestamp (ms)
+		x -- the x coordinate
+		y -- the y coordinate
+
+		Returns:
+		An (x, y) tuple with the filtered position
+		"""
+		
+		return x, y
+		
+	def batch(self, t, x, y):
+	
+		"""
+		Filter a batch of samples
+
+		Arguments:
+		t -- an array of timestamps (ms)
+		x -- an array of x coordinates
+		y -- an array of y coordinates
+
+		Returns:
+		An (x, y) tuple of numpy arrays with the filtered positions
+		"""
+		
+		return numpy.array(x, dtype=float), numpy.array(y, dtype=float)
+		
+class moving_average_filter(gaze_filter_base):
+
+	"""
+	A moving average over the last n samples, implemented with a ring buffer
+	and running sums. Adds (n-1)/2 samples of latency.
+	"""
+	
+	def __init__(self, n=5):
+	
+		"""
+		Constructor
+
+		Keyword arguments:
+		n -- the number of samples to average (default = 5)
+		"""
+		
+		self.n = max(1, int(n))
+		self._bx = array.array('d', [0.] * self.n)
+		self._by = array.array('d', [0.] * self.n)
+		self.reset()
+		
+	def reset(self):
+	
+		"""Forget all previous samples"""
+		
+		self._i = 0
+		self._count = 0
+		self._sx = 0.
+		self._sy = 0.
+		
+	def update(self, t, x, y):
+	
+		"""See gaze_filter_base.update()"""
+		
+		i = self._i
+		if self._count == self.n:
+			self._sx -= self._bx[i]
+			self._sy -= self._by[i]
+		else:
+			self._count += 1
+		self._bx[i] = x
+		self._by[i] = y
+		self._sx += x
+		self._sy += y
+		self._i = (i + 1) % self.n
+		# Recompute the sums once per cycle, so that rounding errors don't
+		# accumulate. This keeps the cost constant when amortized.
+		if self._i == 0 and self._count == self.n:
+			self._sx = sum(self._bx)
+			self._sy = sum(self._by)
+		return self._sx / self._count, self._sy / self._count
+		
+	def _history(self, buf):
+	
+		"""Returns the buffered samples as an array in chronological order"""
+		
+		a = numpy.array(buf, dtype=float)
+		if self._count < self.n:
+			return a[:self._count]
+		return numpy.concatenate((a[self._i:], a[:self._i]))
+		
+	def _batch_axis(self, v, buf):
+	
+		"""Filters a single axis and updates the corresponding buffer"""
+		
+		h = self._history(buf)
+		ext = numpy.concatenate((h, numpy.asarray(v, dtype=float)))
+		cs = numpy.concatenate(([0.], numpy.cumsum(ext)))
+		end = numpy.arange(len(h), len(ext)) + 1
+		start = numpy.maximum(end - self.n, 0)
+		out = (cs[end] - cs[start]) / (end - start)
+		tail = ext[-self.n:]
+		buf[:len(tail)] = array.array('d', tail.tolist())
+		return out, len(tail)
+		
+	def batch(self, t, x, y):
+	
+		"""See gaze_filter_base.batch()"""
+		
+		if len(x) == 0:
+			return gaze_filter_base.batch(self, t, x, y)
+		fx, count = self._batch_axis(x, self._bx)
+		fy, count = self._batch_axis(y, self._by)
+		self._count = count
+		self._i = count % self.n
+		self._sx = sum(self._bx[:count])
+		self._sy = sum(self._by[:count])
+		return fx, fy
+		
+class exponential_filter(gaze_filter_base):
+
+	"""
+	Exponential smoothing: each output moves a fraction alpha towards the
+	new sample. Adds (1-alpha)/alpha samples of latency.
+	"""
+	
+	def __init__(self, alpha=0.5):
+	
+		"""
+		Constructor
+
+		Keyword arguments:
+		alpha -- the smoothing weight between 0 (infinitely smooth) and 1 (no
+				 smoothing) (default = 0.5)
+		"""
+		
+		if alpha <= 0 or alpha > 1:
+			raise exceptions.runtime_error( \
+				"The smoothing weight should be between 0 and 1")
+		self.alpha = float(alpha)
+		self.reset()
+		
+	def reset(self):
+	
+		"""Forget all previous samples"""
+		
+		self._x = None
+		self._y = None
+		
+	def update(self, t, x, y):
+	
+		"""See gaze_filter_base.update()"""
+		
+		if self._x == None:
+			self._x = float(x)
+			self._y = float(y)
+		else:
+			self._x += self.alpha * (x - self._x)
+			self._y += self.alpha * (y - self._y)
+		return self._x, self._y
+		
+	def _batch_axis(self, v, y0):
+	
+		"""
+		Filters a single axis using the closed form of the recursion, which
+		is evaluated in chunks that are short enough not to overflow.
+		"""
+		
+		v = numpy.asarray(v, dtype=float)
+		out = numpy.empty(len(v))
+		if self.alpha == 1:
+			out[:] = v
+			return out
+		b = 1 - self.alpha
+		chunk = max(1, int(300 / -math.log(b)))
+		if y0 == None:
+			y0 = v[0]
+		for i in range(0, len(v), chunk):
+			c = v[i:i + chunk]
+			k = numpy.arange(1, len(c) + 1)
+			out[i:i + len(c)] = b ** k * (y0 + self.alpha * \
+				numpy.cumsum(c * b ** -k))
+			y0 = out[i + len(c) - 1]
+		return out
+		
+	def batch(self, t, x, y):
+	
+		"""See gaze_filter_base.batch()"""
+		
+		if len(x) == 0:
+			return gaze_filter_base.batch(self, t, x, y)
+		fx = self._batch_axis(x, self._x)
+		fy = self._batch_axis(y, self._y)
+		self._x = fx[-1]
+		self._y = fy[-1]
+		return fx, fy
+		
+class one_euro_filter(gaze_filter_base):
+
+	"""
+	The One Euro filter (Casiez, Roussel, & Vogel, 2012): exponential
+	smoothing with a cutoff frequency that increases with the speed of the
+	eyes. The latency is about 1/(2*pi*min_cutoff) s during fixation and
+	drops towards zero during saccades.
+	"""
+	
+	def __init__(self, min_cutoff=1., beta=.007, d_cutoff=1., rate=1000.):
+	
+		"""
+		Constructor
+
+		Keyword arguments:
+		min_cutoff -- the cutoff frequency (Hz) when the eyes are still
+					  (default = 1.)
+		beta -- the increase in cutoff frequency per px/s of gaze speed
+				(default = .007)
+		d_cutoff -- the cutoff frequency (Hz) for the speed estimate
+					(default = 1.)
+		rate -- the sampling rate (Hz), used when timestamps are missing or
+				repeated (default = 1000.)
+		"""
+		
+		self.min_cutoff = float(min_cutoff)
+		self.beta = float(beta)
+		self.d_cutoff = float(d_cutoff)
+		self.rate = float(rate)
+		self.reset()
+		
+	def reset(self):
+	
+		"""Forget all previous samples"""
+		
+		self._started = False
+		self._t = None
+		self._x = 0.
+		self._y = 0.
+		self._dx = 0.
+		self._dy = 0.
+		
+	def _alpha(self, cutoff, dt):
+	
+		"""Returns the smoothing weight for a cutoff frequency"""
+		
+		tau = 1. / (2 * math.pi * cutoff)
+		return 1. / (1. + tau / dt)
+		
+	def update(self, t, x, y):
+	
+		"""See gaze_filter_base.update()"""
+		
+		if self._started == False:
+			self._started = True
+			self._t = t
+			self._x = float(x)
+			self._y = float(y)
+			return self._x, self._y
+		if t == None or self._t == None or t <= self._t:
+			dt = 1. / self.rate
+		else:
+			dt = (t - self._t) / 1000.
+		self._t = t
+		a_d = self._alpha(self.d_cutoff, dt)
+		self._dx += a_d * ((x - self._x) / dt - self._dx)
+		self._dy += a_d * ((y - self._y) / dt - self._dy)
+		speed = math.sqrt(self._dx ** 2 + self._dy ** 2)
+		a = self._alpha(self.min_cutoff + self.beta * speed, dt)
+		self._x += a * (x - self._x)
+		self._y += a * (y - self._y)
+		return self._x, self._y
+		
+	def batch(self, t, x, y):
+	
+		"""
+		See gaze_filter_base.batch(). Because the cutoff depends on the
+		previous output, the samples are processed in a loop, but the output
+		arrays are allocated only once.
+		"""
+		
+		n = len(x)
+		fx = numpy.empty(n)
+		fy = numpy.empty(n)
+		if t is None:
+			t = [None] * n
+		for i in range(n):
+			fx[i], fy[i] = self.update(t[i], x[i], y[i])
+		return fx, fy
+
+gaze_filters = {
+	"moving_average" : moving_average_filter,
+	"exponential" : exponential_filter,
+	"one_euro" : one_euro_filter,
+	}
+
+class linear_gaze_predictor:
+
+	"""
+	Predicts gaze by fitting a straight line (least squares) through the
+	last n samples and extrapolating it to the requested time. Updates cost
+	a constant amount, and predictions cost O(n) for a fixed, small n.
+	
+	Every prediction is kept, in a buffer of fixed size, until a sample
+	arrives at or after the predicted time. The distance between the
+	prediction and that sample is the prediction error. For comparison, the
+	error of simply using the newest sample (i.e. no prediction) is tracked
+	as well.
+	"""
+	
+	def __init__(self, n=5, max_pending=32):
+	
+		"""
+		Constructor
+
+		Keyword arguments:
+		n -- the number of samples used for the fit (default = 5)
+		max_pending -- the maximum number of predictions that await scoring
+					   (default = 32)
+		"""
+		
+		self.n = max(2, int(n))
+		self.max_pending = max(1, int(max_pending))
+		self._bt = array.array('d', [0.] * self.n)
+		self._bx = array.array('d', [0.] * self.n)
+		self._by = array.array('d', [0.] * self.n)
+		# Each pending prediction is stored as: target time, predicted x and
+		# y, and the newest sample x and y at the time of the prediction
+		self._pending = [array.array('d', [0.] * self.max_pending) \
+			for i in range(5)]
+		self.reset()
+		self.reset_stats()
+		
+	def reset(self):
+	
+		"""Forget all previous samples and pending predictions"""
+		
+		self._i = 0
+		self._count = 0
+		self._head = 0
+		self._n_pending = 0
+		
+	def reset_stats(self):
+	
+		"""Reset the error statistics"""
+		
+		self.n_scored = 0
+		self.n_dropped = 0
+		self._sum_err = 0.
+		self._sum_err2 = 0.
+		self._max_err = 0.
+		self._sum_base = 0.
+		
+	def update(self, t, x, y):
+	
+		"""
+		Add a new sample and score the predictions that it resolves
+
+		Arguments:
+		t -- the sample timestamp (ms)
+		x -- the x coordinate
+		y -- the y coordinate
+		"""
+		
+		i = self._i
+		self._bt[i] = t
+		self._bx[i] = x
+		self._by[i] = y
+		self._i = (i + 1) % self.n
+		self._count = min(self._count + 1, self.n)
+		
+		pt, px, py, bx, by = self._pending
+		while self._n_pending > 0 and pt[self._head] <= t:
+			j = self._head
+			err = math.sqrt((px[j] - x) ** 2 + (py[j] - y) ** 2)
+			self.n_scored += 1
+			self._sum_err += err
+			self._sum_err2 += err ** 2
+			self._max_err = max(self._max_err, err)
+			self._sum_base += math.sqrt((bx[j] - x) ** 2 + (by[j] - y) ** 2)
+			self._head = (j + 1) % self.max_pending
+			self._n_pending -= 1
+		
+	def predict(self, t):
+	
+		"""
+		Predict the gaze position at a given time
+
+		Arguments:
+		t -- the time for which to predict (ms, in the same clock as the
+			 sample timestamps)
+
+		Returns:
+		An (x, y) tuple with the predicted position
+		"""
+		
+		if self._count == 0:
+			raise exceptions.runtime_error("No gaze sample is available yet")
+		newest = (self._i - 1) % self.n
+		if self._count < 2:
+			x, y = self._bx[newest], self._by[newest]
+		else:
+			k = self._count
+			idx = [(self._i - 1 - j) % self.n for j in range(k)]
+			mt = sum([self._bt[j] for j in idx]) / k
+			mx = sum([self._bx[j] for j in idx]) / k
+			my = sum([self._by[j] for j in idx]) / k
+			stt = sum([(self._bt[j] - mt) ** 2 for j in idx])
+			if stt == 0:
+				x, y = mx, my
+			else:
+				vx = sum([(self._bt[j] - mt) * (self._bx[j] - mx) for j in idx])
+				vy = sum([(self._bt[j] - mt) * (self._by[j] - my) for j in idx])
+				x = mx + vx / stt * (t - mt)
+				y = my + vy / stt * (t - mt)
+		
+		# Queue the prediction for scoring, dropping the oldest if necessary
+		if self._n_pending == self.max_pending:
+			self._head = (self._head + 1) % self.max_pending
+			self._n_pending -= 1
+			self.n_dropped += 1
+		j = (self._head + self._n_pending) % self.max_pending
+		pt, px, py, bx, by = self._pending
+		pt[j] = t
+		px[j] = x
+		py[j] = y
+		bx[j] = self._bx[newest]
+		by[j] = self._by[newest]
+		self._n_pending += 1
+		return x, y
+		
+	def stats(self):
+	
+		"""
+		Returns:
+		A dictionary with the number of scored predictions, and the mean,
+		root-mean-square, and maximum prediction error, and the mean error
+		without prediction (px)
+		"""
+		
+		n = max(1, self.n_scored)
+		return {
+			"n" : self.n_scored,
+			"error_mean" : self._sum_err / n,
+			"error_rms" : math.sqrt(self._sum_err2 / n),
+			"error_max" : self._max_err,
+			"error_baseline" : self._sum_base / n,
+			}
+
+gaze_predictors = {
+	"linear" : linear_gaze_predictor,
+	}
+
+class stability_detector:
+
+	"""
+	Decides whether gaze is stable, based on the last n samples. The
+	samples are kept in a ring buffer together with running sums of the
+	coordinates and their squares, so that each update costs a constant
+	amount. Gaze is stable when the window is full and the dispersion (the
+	root-mean-square distance of the samples from their average) does not
+	exceed max_dispersion.
+	"""
+	
+	def __init__(self, n=30, max_dispersion=10):
+	
+		"""
+		Constructor
+
+		Keyword arguments:
+		n -- the number of samples in the window (default = 30)
+		max_dispersion -- the maximum dispersion of stable samples
+						  (default = 10)
+		"""
+		
+		self.n = max(1, int(n))
+		self.max_dispersion = max_dispersion
+		self._bx = array.array('d', [0.] * self.n)
+		self._by = array.array('d', [0.] * self.n)
+		self.reset()
+		
+	def reset(self):
+	
+		"""Forget all previous samples"""
+		
+		self._i = 0
+		self._count = 0
+		self._sx = 0.
+		self._sy = 0.
+		self._sxx = 0.
+		self._syy = 0.
+		
+	def update(self, x, y):
+	
+		"""
+		Add a sample to the window
+
+		Arguments:
+		x -- the x coordinate
+		y -- the y coordinate
+		"""
+		
+		i = self._i
+		if self._count == self.n:
+			ox = self._bx[i]
+			oy = self._by[i]
+			self._sx -= ox
+			self._sy -= oy
+			self._sxx -= ox ** 2
+			self._syy -= oy ** 2
+		else:
+			self._count += 1
+		self._bx[i] = x
+		self._by[i] = y
+		self._sx += x
+		self._sy += y
+		self._sxx += x ** 2
+		self._syy += y ** 2
+		self._i = (i + 1) % self.n
+		# Recompute the sums once per cycle, so that rounding errors don't
+		# accumulate
+		if self._i == 0 and self._count == self.n:
+			self._sx = sum(self._bx)
+			self._sy = sum(self._by)
+			self._sxx = sum([v ** 2 for v in self._bx])
+			self._syy = sum([v ** 2 for v in self._by])
+			
+	def mean(self):
+	
+		"""
+		Returns:
+		An (x, y) tuple with the average position in the window
+		"""
+		
+		n = max(1, self._count)
+		return self._sx / n, self._sy / n
+		
+	def dispersion(self):
+	
+		"""
+		Returns:
+		The root-mean-square distance of the samples from their average
+		"""
+		
+		n = max(1, self._count)
+		mx, my = self.mean()
+		return math.sqrt(max(0., self._sxx / n - mx ** 2 + self._syy / n \
+			- my ** 2))
+		
+	def stable(self):
+	
+		"""
+		Returns:
+		True if the window is full and the dispersion is small enough, False
+		otherwise
+		"""
+		
+		return self._count == self.n and self.dispersion() <= \
+			self.max_dispersion
+
+# The time (ms) that it took to load this module
+_load_time = 1000. * (time.time() - _t_load)
@@ -20,6 +20,7 @@ from libqtopensesame import qtplugin
 import openexp.canvas
 import os.path
 import imp
+import collections
 from PyQt4 import QtGui, QtCore
 
 class eyelink_drift_correct(item.item):
@@ -30,6 +31,9 @@ class eyelink_drift_correct(item.item):
 	not deal with GUI stuff.
 	"""
 
+	# The number of rendered target canvases that are kept
+	CANVAS_CACHE_SIZE = 4
+
 	def __init__(self, name, experiment, string = None):
 
 		"""
@@ -45,6 +49,14 @@ class eyelink_drift_correct(item.item):
 
 		self.xpos = 0
 		self.ypos = 0
+		self.accept_threshold = 60
+		self.recal_threshold = 120
+		self.max_retries = 1
+		self.fix_timeout = 10000
+
+		# The most recently used target canvases, keyed by (x, y, background,
+		# foreground), with the most recent one last
+		self._canvas_cache = collections.OrderedDict()
 
 		# Provide a short accurate description of the items functionality
 		self.description = "Drift correction plugin for the Eyelink series of eye trackers (SR-Research)"
@@ -56,7 +68,10 @@ class eyelink_drift_correct(item.item):
 
 		"""
 		Prepare the item. In this case this means drawing a fixation
-		dot to an offline canvas.
+		dot to an offline canvas. The last few canvases are cached, so
+		that a target that has been drawn recently is not drawn again,
+		while a target that moves from trial to trial doesn't keep a
+		canvas for every position.
 		"""
 
 		# Pass the word on to the parent
@@ -67,6 +82,40 @@ class eyelink_drift_correct(item.item):
 		if not hasattr(self.experiment, "eyelink"):
 			raise exceptions.runtime_error("Please connect to the eyelink using the the eyelink_calibrate plugin before using any other eyelink plugins")
 
+		try:
+			x = int(self.get("xpos", _eval=True))
+			y = int(self.get("ypos", _eval=True))
+		except:
+			raise exceptions.runtime_error("Please use numeric values for the coordinates in eyelink_drift_correct item '%s'" % self.name)
+
+		if not self.has("coordinates") or self.get("coordinates") == "relative":
+			x += self.get("width") / 2
+			y += self.get("height") / 2
+
+		# Draw a fixation dot, unless we have already done so
+		key = x, y, self.get("background"), self.get("foreground")
+		if key in self._canvas_cache:
+			c = self._canvas_cache.pop(key)
+		else:
+			c = openexp.canvas.canvas(self.experiment, self.get("background"), self.get("foreground"))
+			c.set_penwidth(3)
+			c.line(x - 5, y, x + 5, y)
+			c.line(x, y - 5, x, y + 5)
+			if len(self._canvas_cache) >= self.CANVAS_CACHE_SIZE:
+				self._canvas_cache.popitem(last=False)
+		self._canvas_cache[key] = c
+		self._target = x, y
+		self._canvas = c
+		
+		# A timeout of 0 means no timeout
+		self._timeout = self.get("fix_timeout")
+		if self._timeout <= 0:
+			self._timeout = None
+		
+		# Items that are prepared after this one shouldn't start the tracker
+		# ahead of time, because drift correction would stop it again
+		self.experiment.eyelink.expect_setup()
+
 		# Report success
 		return True
 
@@ -78,27 +127,15 @@ class eyelink_drift_correct(item.item):
 		"""
 
 		self.set_item_onset()
-
-		try:
-			x = int(self.get("xpos", _eval=True))
-			y = int(self.get("ypos", _eval=True))
-		except:
-			raise exceptions.runtime_error("Please use numeric values for the coordinates in eyelink_drift_correct item '%s'" % self.name)
-
-		if not self.has("coordinates") or self.get("coordinates") == "relative":
-			x += self.get("width") / 2
-			y += self.get("height") / 2
-
-		# Draw a fixation dot
-		c = openexp.canvas.canvas(self.experiment, self.get("background"), self.get("foreground"))
-		c.set_penwidth(3)
-		c.line(x - 5, y, x + 5, y)
-		c.line(x, y - 5, x, y + 5)
-		c.show()
-		# Do drift correction
-		while not self.experiment.eyelink.drift_correction( (x, y), self.get("mode") == self._mode_auto):
-			self.experiment.eyelink.calibrate()
-			c.show()
+		self._canvas.show()
+		
+		# Do drift correction, and recalibrate only if the error is large
+		self.experiment.eyelink.checked_drift_correction(self._target, \
+			self.get("mode") == self._mode_auto, \
+			accept_threshold = self.get("accept_threshold"), \
+			recalibrate_threshold = self.get("recal_threshold"), \
+			max_retries = self.get("max_retries"), target_canvas = self._canvas, \
+			timeout = self._timeout)
 
 		# Report success
 		return True
@@ -142,6 +179,14 @@ class qteyelink_drift_correct(eyelink_drift_correct, qtplugin.qtplugin):
 		else:
 			self.add_line_edit_control("xpos", "X coordinate", 0)
 			self.add_line_edit_control("ypos", "Y coordinate", 0)
+		self.add_spinbox_control("accept_threshold", "Accept error below", 0, 10000, \
+			tooltip = "The maximum error (in pixels) that is accepted without repeating drift correction")
+		self.add_spinbox_control("recal_threshold", "Recalibrate error above", 0, 10000, \
+			tooltip = "The error (in pixels) above which the tracker is recalibrated")
+		self.add_spinbox_control("max_retries", "Retries before recalibration", 0, 100, \
+			tooltip = "The number of times drift correction is repeated before the tracker is recalibrated")
+		self.add_spinbox_control("fix_timeout", "Timeout (automatic mode)", 0, 100000, \
+			tooltip = "The maximum time (in ms) to wait for a stable fixation in automatic mode, after which drift correction is repeated or, after the maximum number of retries, the tracker is recalibrated. 0 means no timeout.")
 
 		# Add a stretch to the edit_vbox, so that the controls do not
 		# stretch to the bottom of the window.
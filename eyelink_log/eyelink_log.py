@@ -60,7 +60,9 @@ class eyelink_log(item.item):
 		if not hasattr(self.experiment, "eyelink"):
 			raise exceptions.runtime_error("Please connect to the eyelink using the the eyelink_calibrate plugin before using any other eyelink plugins")
 			
-		self._msg = self.msg.split("\n")
+		# Parse the messages now, so that only the variables need to be
+		# filled in during the run phase
+		self._msg = [self.experiment.eyelink.compile_message(msg, self) for msg in self.msg.split("\n")]
 																
 		# Report success
 		return True
@@ -74,9 +76,7 @@ class eyelink_log(item.item):
 		
 		self.set_item_onset()
 		
-		for msg in self._msg:
-			self.experiment.eyelink.log(self.eval_text(msg))
-			self.sleep(2)
+		self.experiment.eyelink.log_batch([msg.render() for msg in self._msg])
 				
 		# Report success
 		return True
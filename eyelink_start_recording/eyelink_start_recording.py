@@ -49,6 +49,8 @@ class eyelink_start_recording(item.item):
 		
 		if not hasattr(self, "log_msg"):
 			self.log_msg = "start_trial"
+		if not hasattr(self, "prearm"):
+			self.prearm = "no"
 						
 	def prepare(self):
 	
@@ -64,6 +66,14 @@ class eyelink_start_recording(item.item):
 		# dynamically loaded
 		if not hasattr(self.experiment, "eyelink"):
 			raise exceptions.runtime_error("Please connect to the eyelink using the the eyelink_calibrate plugin before using any other eyelink plugins")
+			
+		# Parse the message now, so that only the variables need to be
+		# filled in during the run phase
+		self._log_msg = self.experiment.eyelink.compile_message(self.get("log_msg", _eval=False), self)
+			
+		# Start the tracker already, so that run() doesn't have to wait for it
+		if self.get("prearm") == "yes":
+			self.experiment.eyelink.prearm_recording()
 				
 		# Report success
 		return True
@@ -77,9 +87,11 @@ class eyelink_start_recording(item.item):
 		
 		self.set_item_onset()
 	
+		msg = self._log_msg.render()
+		# The status message is sent once recording has started
+		self.experiment.eyelink.status_msg(msg)
 		self.experiment.eyelink.start_recording()
-		self.experiment.eyelink.status_msg(self.eval_text(self.get("log_msg")))
-		self.experiment.eyelink.log(self.eval_text(self.get("log_msg")))
+		self.experiment.eyelink.log(msg)
 				
 		# Report success
 		return True
@@ -116,6 +128,8 @@ class qteyelink_start_recording(eyelink_start_recording, qtplugin.qtplugin):
 		# Pass the word on to the parent		
 		qtplugin.qtplugin.init_edit_widget(self, False)			
 		self.add_line_edit_control("log_msg", "Log message", default = "start_trial", tooltip = "A message to write to the eyelink logfile.", min_width = 400)
+		self.add_combobox_control("prearm", "Start tracker during prepare", ["no", "yes"], \
+			tooltip = "Start the tracker during the prepare phase, so that recording starts without delay. This is skipped if a drift correction or calibration item has been prepared before this item, because it would stop the tracker again.")
 		
 		# Add a stretch to the edit_vbox, so that the controls do not
 		# stretch to the bottom of the window.
@@ -49,6 +49,12 @@ class eyelink_stop_recording(item.item):
 		
 		if not hasattr(self, "log_msg"):
 			self.log_msg = "stop_trial"
+		if not hasattr(self, "deferred"):
+			self.deferred = "no"
+		if not hasattr(self, "var_snapshot"):
+			self.var_snapshot = "no"
+		if not hasattr(self, "snapshot_vars"):
+			self.snapshot_vars = ""
 						
 	def prepare(self):
 	
@@ -64,6 +70,18 @@ class eyelink_stop_recording(item.item):
 		# dynamically loaded
 		if not hasattr(self.experiment, "eyelink"):
 			raise exceptions.runtime_error("Please connect to the eyelink using the the eyelink_calibrate plugin before using any other eyelink plugins")
+			
+		# Parse the message now, so that only the variables need to be
+		# filled in during the run phase
+		self._log_msg = self.experiment.eyelink.compile_message(self.get("log_msg", _eval=False), self)
+		
+		# Determine which variables are written to the data file after the
+		# trial
+		self._snapshot = self.get("var_snapshot")
+		if self._snapshot == "selected variables":
+			self._snapshot_vars = ("%s" % self.get("snapshot_vars")).split()
+		else:
+			self._snapshot_vars = None
 				
 		# Report success
 		return True
@@ -77,9 +95,13 @@ class eyelink_stop_recording(item.item):
 		
 		self.set_item_onset()
 
-		self.experiment.eyelink.status_msg(self.eval_text(self.get("log_msg")))	
-		self.experiment.eyelink.log(self.eval_text(self.get("log_msg")))	
-		self.experiment.eyelink.stop_recording()
+		msg = self._log_msg.render()
+		self.experiment.eyelink.status_msg(msg)	
+		self.experiment.eyelink.log(msg)	
+		self.experiment.eyelink.stop_recording(deferred = self.get("deferred") == "yes")
+		if self._snapshot != "no":
+			self.experiment.eyelink.log_var_snapshot(self._snapshot_vars, \
+				changed_only = self._snapshot == "changed variables")
 				
 		# Report success
 		return True
@@ -116,6 +138,12 @@ class qteyelink_stop_recording(eyelink_stop_recording, qtplugin.qtplugin):
 		# Pass the word on to the parent		
 		qtplugin.qtplugin.init_edit_widget(self, False)			
 		self.add_line_edit_control("log_msg", "Log message", default = "stop_trial", tooltip = "A message to write to the eyelink logfile.", min_width = 400)
+		self.add_combobox_control("deferred", "Stop tracker in background", ["no", "yes"], \
+			tooltip = "Continue immediately, and let the tracker stop while the next trial is prepared. The stop time (eyelink_stop_settle) is then not measured.")
+		self.add_combobox_control("var_snapshot", "Write variables", ["no", "changed variables", "all variables", "selected variables"], \
+			tooltip = "Write variables to the eyelink logfile after recording has stopped")
+		self.add_line_edit_control("snapshot_vars", "Selected variables", default = "", \
+			tooltip = "A space-separated list of variables to write, if 'selected variables' is chosen", min_width = 400)
 		
 		# Add a stretch to the edit_vbox, so that the controls do not
 		# stretch to the bottom of the window.